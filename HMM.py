@@ -1,7 +1,89 @@
 import copy
+from collections import deque
 
 import numpy as np
 
+# per-process state for parallel E-step workers (set up once by _init_estep_worker)
+_worker_model = None
+_worker_sequences = None
+_worker_blocks = []
+
+
+def _init_estep_worker(true_states, observable_states, shared_params, sequences):
+    """
+    attaches a pool worker to the shared parameter blocks and keeps its share of the corpus
+    shared_params maps each parameter name to (shared memory name, shape, dtype)
+    """
+    global _worker_model, _worker_sequences
+    from multiprocessing import shared_memory
+
+    params = {}
+    for key, (name, shape, dtype) in shared_params.items():
+        # pool workers share the parent's resource tracker, and the parent unlinks the block when training ends
+        block = shared_memory.SharedMemory(name=name)
+        _worker_blocks.append(block)
+        params[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    _worker_model = HiddenMarkovModel(
+        true_states, observable_states, params["T"], params["E"], params["start_probs"], params["end_probs"])
+    _worker_sequences = sequences
+
+
+def _estep_shard(indices):
+    """
+    E-step for one shard of sequences, reading the current parameters from shared memory
+    """
+    return _worker_model.expected_counts([_worker_sequences[i] for i in indices])
+
+
+def _sum_counts(all_counts):
+    """
+    reduces the expected counts of several shards into one set of pooled counts
+    """
+    return {key: sum(counts[key] for counts in all_counts) for key in all_counts[0]}
+
+
+class _ParallelEStep:
+    """
+    spreads the E-step of pooled Baum-Welch across a process pool
+    T, E, start and end probabilities live in shared memory, so each iteration only sends shard indices
+    """
+
+    def __init__(self, model, sequences, workers):
+        # imported here so loading HMM for prediction does not pay for the multiprocessing machinery
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import shared_memory
+
+        self.model = model
+        self.blocks = []
+        self.params = {}
+        shared_params = {}
+        for key in ("T", "E", "start_probs", "end_probs"):
+            array = np.asarray(getattr(model, key), dtype=float)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            self.blocks.append(block)
+            self.params[key] = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            shared_params[key] = (block.name, array.shape, array.dtype)
+
+        # longest sequences first, dealt round-robin, so shards get similar amounts of work
+        order = np.argsort([-len(seq) for seq in sequences], kind="stable")
+        self.shards = [order[i::workers].tolist() for i in range(min(workers, len(sequences)))]
+        self.pool = ProcessPoolExecutor(
+            max_workers=len(self.shards),
+            initializer=_init_estep_worker,
+            initargs=(model.true_states, model.observable_states, shared_params, list(sequences)),
+        )
+
+    def __call__(self, sequences):
+        for key, view in self.params.items():
+            view[...] = getattr(self.model, key)
+        return _sum_counts(list(self.pool.map(_estep_shard, self.shards)))
+
+    def close(self):
+        self.pool.shutdown()
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
 
 class HiddenMarkovModel:
     def __init__(
@@ -26,23 +108,69 @@ class HiddenMarkovModel:
         # eta: [state, observation]
         # xi: [state, observation, next_state]
 
+    @property
+    def is_sparse(self):
+        """
+        true when T and E are scipy sparse matrices (see prune)
+        """
+        return hasattr(self.T, "tocsc")
+
+    @staticmethod
+    def _prune_rows(matrix, top_k, threshold):
+        """
+        keeps the top_k largest entries of every row that are above threshold, rescaling each row to its old sum
+        """
+        matrix = np.asarray(matrix.toarray() if hasattr(matrix, "toarray") else matrix, dtype=float)
+        keep = matrix > threshold
+        if top_k is not None and top_k < matrix.shape[1]:
+            top = np.zeros(matrix.shape, dtype=bool)
+            np.put_along_axis(top, np.argpartition(-matrix, top_k - 1, axis=1)[:, :top_k], True, axis=1)
+            keep &= top
+        pruned = np.where(keep, matrix, 0.0)
+        totals, kept = matrix.sum(axis=1), pruned.sum(axis=1)
+        return pruned * np.divide(totals, kept, out=np.zeros(kept.shape), where=kept > 0)[:, None]
+
+    def prune(self, top_k=None, threshold=0.0, sparse=True):
+        """
+        returns a copy of the model keeping only the top_k largest entries above threshold in every row of T and E
+        each row is rescaled to its old sum, so rows of T plus the end probabilities still sum to 1
+        with sparse=True T is stored as a CSR and E as a CSC matrix (scipy is optional: without it the pruned
+        arrays stay dense), and forward, backward and decoding then only touch the kept entries
+        training needs dense parameters: train first, then prune the trained model for prediction
+        """
+        transitions = self._prune_rows(self.T, top_k, threshold)
+        emissions = self._prune_rows(self.E, top_k, threshold)
+        if sparse:
+            try:
+                from scipy import sparse as scipy_sparse
+            except ImportError:
+                scipy_sparse = None
+            if scipy_sparse is not None:
+                transitions = scipy_sparse.csr_array(transitions)
+                emissions = scipy_sparse.csc_array(emissions)
+        return HiddenMarkovModel(self.true_states, self.observable_states, transitions, emissions,
+                                 self.start_probs, self.end_probs)
+
+    def _emission_columns(self, sequence):
+        """
+        gathers the emission probability of every state for each observation in the sequence
+        returns an array shaped [state, time]
+        """
+        columns = self.E[:, self.observable_states[np.asarray(sequence)]]
+        return columns.toarray() if self.is_sparse else columns
+
     def forward(self, sequence):
         """
         calculates the joint probability of observed data up to time k and the state at time k
         p(obsv 0:k, state k)
         """
+        emissions = self._emission_columns(sequence)
         forward_vals = np.zeros((len(self.true_states), len(sequence)))
-        for i in range(len(sequence)):
-            state_idx = sequence[i]
-            for j in range(len(self.true_states)):
-                # case for start of sequence (need this bc formula is recursive and must have start value)
-                if i == 0:
-                    forward_vals[j, i] = self.start_probs[j] * self.E[j, self.observable_states[state_idx]]
-                else:
-                    vals = np.array(
-                        [forward_vals[k, i - 1] * self.E[j, self.observable_states[state_idx]] * self.T[k, j]
-                            for k in range(len(self.true_states))])
-                    forward_vals[j, i] = np.sum(vals)
+        # case for start of sequence (need this bc formula is recursive and must have start value)
+        forward_vals[:, 0] = self.start_probs * emissions[:, 0]
+        for i in range(1, len(sequence)):
+            # sum over every predecessor state at once: forward[k] * T[k, j]
+            forward_vals[:, i] = (forward_vals[:, i - 1] @ self.T) * emissions[:, i]
         end = np.multiply(forward_vals[:, -1], self.end_probs)
         end_val = np.sum(end)
         return forward_vals, end_val
@@ -52,182 +180,548 @@ class HiddenMarkovModel:
         calculates the conditional probabilities of the observed data from time k+1 given the state at time k
         p(obsv k+1: | state k)
         """
+        emissions = self._emission_columns(sequence)
         backward_vals = np.zeros((len(self.true_states), len(sequence)))
-        for i in range(1, len(sequence) + 1):
-            for j in range(len(self.true_states)):
-                # case for end of sequence (this is recursive and needs a start value)
-                if i == 1:
-                    backward_vals[j, -i] = self.end_probs[j]
-                else:
-                    vals = np.array(
-                        [
-                            backward_vals[k, -i + 1] * self.E[k, self.observable_states[sequence[-i + 1]]] * self.T[k, j]
-                            for k in range(len(self.true_states))
-                        ]
-                    )
-                    backward_vals[j, -i] = np.sum(vals)
-        start_state = [
-            backward_vals[i, 0] * self.E[i, self.observable_states[sequence[0]]]
-            for i in range(len(self.true_states))
-        ]
+        # case for end of sequence (this is recursive and needs a start value)
+        backward_vals[:, -1] = self.end_probs
+        for i in range(len(sequence) - 2, -1, -1):
+            # sum over every following state at once: backward[k] * E[k, obsv] * T[k, j]
+            backward_vals[:, i] = (backward_vals[:, i + 1] * emissions[:, i + 1]) @ self.T
+        start_state = backward_vals[:, 0] * emissions[:, 0]
         start_state = np.multiply(start_state, self.start_probs)
         start_val = np.sum(start_state)
         return backward_vals, start_val
 
+    def forward_scaled(self, sequence):
+        """
+        forward pass normalized at every time step so long sequences do not underflow
+        returns p(state k | obsv 0:k) and the per-step normalizers c_k = p(obsv k | obsv 0:k-1)
+        the last normalizer also absorbs the end probabilities, so sum(log(scales)) is the log-likelihood
+        """
+        emissions = self._emission_columns(sequence)
+        forward_vals = np.zeros((len(self.true_states), len(sequence)))
+        scales = np.zeros(len(sequence) + 1)
+        alpha = self.start_probs * emissions[:, 0]
+        for i in range(len(sequence)):
+            if i > 0:
+                alpha = (forward_vals[:, i - 1] @ self.T) * emissions[:, i]
+            scales[i] = np.sum(alpha)
+            forward_vals[:, i] = alpha / scales[i] if scales[i] > 0 else alpha
+        scales[-1] = np.sum(forward_vals[:, -1] * self.end_probs)
+        return forward_vals, scales
+
+    def backward_scaled(self, sequence, scales):
+        """
+        backward pass divided by the normalizers from forward_scaled
+        forward_scaled * backward_scaled is then p(state k | obsv) directly
+        unlike backward, this sums over next states with T[j, k] (the standard recursion), so the
+        scaled posteriors are consistent with forward_scaled
+        """
+        emissions = self._emission_columns(sequence)
+        scales = np.where(scales > 0, scales, 1.0)
+        backward_vals = np.zeros((len(self.true_states), len(sequence)))
+        backward_vals[:, -1] = self.end_probs / scales[-1]
+        for i in range(len(sequence) - 2, -1, -1):
+            backward_vals[:, i] = self.T @ (backward_vals[:, i + 1] * emissions[:, i + 1]) / scales[i + 1]
+        return backward_vals
+
+    def log_likelihood(self, sequence):
+        """
+        log p(obsv) computed from the scaled forward pass, finite for sequences of any length
+        """
+        _, scales = self.forward_scaled(sequence)
+        with np.errstate(divide="ignore"):
+            return np.sum(np.log(scales))
+
     def eta(self, forward_probs, backward_probs, forward_val, sequence):
         """
         calculates the probability distribution of states at each time k given the complete observation sequence
         """
-        eta_probs = np.zeros((len(self.true_states), len(sequence)))
-        for i in range(len(sequence)):
-            for j in range(len(self.true_states)):
-                eta_probs[j, i] = (
-                    forward_probs[j, i] * backward_probs[j, i]
-                ) / forward_val
-        return eta_probs
+        return forward_probs * backward_probs / forward_val
 
-    def xi(self, forward_probs, backward_probs, forward_val, sequence):
+    def xi(self, forward_probs, backward_probs, forward_val, sequence, scales=None, summed=False):
         """
         calculates the joint probabilities of all consecutive state pairs given the complete observation sequence
+        when scales (from forward_scaled) are given, the probabilities are scaled values and forward_val should be 1
+        summed=True returns only the [state, next_state] sums over time (all the M-step needs), without
+        building the full [state, time, next_state] tensor
         """
-        xi_probs = np.zeros(
-            (len(self.true_states), len(sequence) - 1, len(self.true_states)))
-        for i in range(len(sequence) - 1):
-            for j in range(len(self.true_states)):
-                for k in range(len(self.true_states)):
-                    xi_probs[j, i, k] = (
-                        forward_probs[j, i]
-                        * backward_probs[k, i + 1]
-                        * self.E[k, self.observable_states[sequence[i + 1]]] * self.T[j, k]
-                    ) / forward_val
-        return xi_probs
+        step_scales = np.ones(len(sequence)) if scales is None else scales
+        # backward[k, i + 1] * E[k, obsv i + 1] for every following state k and time i
+        following = backward_probs[:, 1:] * self._emission_columns(sequence)[:, 1:] / step_scales[1:len(sequence)]
+        if summed:
+            return (forward_probs[:, :-1] @ following.T) * self.T / forward_val
+        return forward_probs[:, :-1, None] * self.T[:, None, :] * following.T[None, :, :] / forward_val
 
-    def train(self, sequence, iterations=1000, end=False):
+    @staticmethod
+    def _ratio(vals, totals):
         """
-        tunes the transition and emission matrices so the model is maximally like the observed data
+        vals / totals for the M-step, with 0 where vals is 0 and 1 where only totals is 0
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(vals == 0, 0.0, np.where(totals == 0, 1.0, vals / totals))
+
+    def _emission_counts(self, sequence, eta_probs):
+        """
+        sums eta [state, time] per observable state in one bincount over (state, observation) ids
+        """
+        lookup = np.full(np.max(self.observable_states) + 1, -1)
+        lookup[self.observable_states] = np.arange(len(self.observable_states))
+        columns = lookup[np.asarray(sequence)]
+        n_states, n_obs = eta_probs.shape[0], len(self.observable_states)
+        valid = columns >= 0
+        ids = np.arange(n_states)[:, None] * n_obs + columns[valid]
+        return np.bincount(ids.ravel(), weights=eta_probs[:, valid].ravel(),
+                           minlength=n_states * n_obs).reshape(n_states, n_obs)
+
+    def _pad_sequences(self, sequences):
+        """
+        packs ragged observation sequences into one zero-padded array of emission column indices
+        returns the padded array [sequence, time] and the length of each sequence
+        """
+        lengths = np.array([len(seq) for seq in sequences])
+        padded = np.zeros((len(sequences), lengths.max()), dtype=int)
+        mask = np.arange(lengths.max()) < lengths[:, None]
+        padded[mask] = self.observable_states[np.concatenate([np.asarray(seq) for seq in sequences])]
+        return padded, lengths
+
+    def forward_batch(self, padded, lengths):
+        """
+        scaled forward pass over a padded batch of sequences at once
+        returns forward probs [sequence, time, state], per-step scales [sequence, time] and the end scales [sequence]
+        positions past the end of a sequence have forward probs of 0 and a scale of 1
+        """
+        emissions = self.E.T[padded]
+        live = np.arange(padded.shape[1]) < lengths[:, None]
+        forward_vals = np.zeros(emissions.shape)
+        scales = np.ones(padded.shape)
+        alpha = self.start_probs * emissions[:, 0]
+        for i in range(padded.shape[1]):
+            if i > 0:
+                alpha = (forward_vals[:, i - 1] @ self.T) * emissions[:, i]
+            alpha = np.where(live[:, i, None], alpha, 0)
+            step_scale = np.sum(alpha, axis=1)
+            scales[:, i] = np.where(step_scale > 0, step_scale, 1.0)
+            forward_vals[:, i] = alpha / scales[:, i, None]
+        last = forward_vals[np.arange(len(lengths)), lengths - 1]
+        end_scales = np.sum(last * self.end_probs, axis=1)
+        return forward_vals, scales, end_scales
+
+    def backward_batch(self, padded, lengths, scales, end_scales):
+        """
+        scaled backward pass over a padded batch, the counterpart of forward_batch
+        returns backward probs [sequence, time, state]
+        """
+        emissions = self.E.T[padded]
+        backward_vals = np.zeros(emissions.shape)
+        end_scales = np.where(end_scales > 0, end_scales, 1.0)
+        backward_vals[np.arange(len(lengths)), lengths - 1] = self.end_probs / end_scales[:, None]
+        for i in range(padded.shape[1] - 2, -1, -1):
+            beta = (backward_vals[:, i + 1] * emissions[:, i + 1]) @ self.T.T / scales[:, i + 1, None]
+            backward_vals[:, i] = np.where((i < lengths - 1)[:, None], beta, backward_vals[:, i])
+        return backward_vals
+
+    def expected_counts(self, sequences):
+        """
+        runs one E-step over a list of sequences and pools the expected counts across all of them
+        returns a dict of summable statistics: start, end, occupancy (eta summed over time),
+        transitions (xi summed over time), emissions (eta summed per observation) and log_likelihood
+        """
+        padded, lengths = self._pad_sequences(sequences)
+        forward_vals, scales, end_scales = self.forward_batch(padded, lengths)
+        backward_vals = self.backward_batch(padded, lengths, scales, end_scales)
+        eta_probs = forward_vals * backward_vals
+
+        live = np.arange(padded.shape[1]) < lengths[:, None]
+        n_states, n_obs = self.E.shape
+        ids = padded[live][:, None] + np.arange(n_states) * n_obs
+        emissions = np.bincount(ids.ravel(), weights=eta_probs[live].ravel(),
+                                minlength=n_states * n_obs).reshape(n_states, n_obs)
+
+        # xi summed over time: forward[j] * T[j, k] * E[k, obsv] * backward[k] / scale
+        emission_vals = self.E.T[padded]
+        xi_sum = np.zeros(self.T.shape)
+        for i in range(padded.shape[1] - 1):
+            following = backward_vals[:, i + 1] * emission_vals[:, i + 1] / scales[:, i + 1, None]
+            following = np.where((i < lengths - 1)[:, None], following, 0)
+            xi_sum += forward_vals[:, i].T @ following
+        xi_sum *= self.T
+
+        with np.errstate(divide="ignore"):
+            log_likelihood = np.sum(np.log(scales)) + np.sum(np.log(end_scales))
+        return {
+            "start": eta_probs[:, 0].sum(axis=0),
+            "end": eta_probs[np.arange(len(lengths)), lengths - 1].sum(axis=0),
+            "occupancy": eta_probs.sum(axis=(0, 1)),
+            "transitions": xi_sum,
+            "emissions": emissions,
+            "log_likelihood": log_likelihood,
+            "n_sequences": len(sequences),
+        }
+
+    def maximize(self, counts, end=False):
+        """
+        M-step: re-estimates start, end, transition and emission probabilities from pooled expected counts
+        each row of T plus the matching end probability sums to 1
+        """
+        occupancy = counts["occupancy"]
+        visited = occupancy > 0
+        self.T = np.divide(counts["transitions"], occupancy[:, None], out=np.zeros(self.T.shape),
+                           where=visited[:, None])
+        self.E = np.divide(counts["emissions"], occupancy[:, None], out=np.zeros(self.E.shape),
+                           where=visited[:, None])
+        self.end_probs = np.divide(counts["end"], occupancy, out=np.zeros(occupancy.shape), where=visited)
+        self.start_probs = counts["start"] / counts["n_sequences"]
+        if end:
+            self.T[self.true_states[-1], self.true_states[-1]] = 1
+
+    def _train_batch(self, sequences, iterations, end, tol, workers=None):
+        """
+        pooled Baum-Welch over many sequences: one E-step across the whole corpus per iteration
+        with workers > 1 the E-step is sharded across a process pool and the counts are summed here
+        """
+        if workers is not None and workers > 1:
+            estep = _ParallelEStep(self, sequences, workers)
+        else:
+            estep = self.expected_counts
+        try:
+            counts = estep(sequences)
+            for _ in range(iterations):
+                self.maximize(counts, end)
+                fit_val = counts["log_likelihood"]
+                counts = estep(sequences)
+                print("-----------------------")
+                print(f"Update Iteration Complete (log-likelihood {counts['log_likelihood']:.4f})")
+                if np.abs(counts["log_likelihood"] - fit_val) <= tol:
+                    break
+        finally:
+            if isinstance(estep, _ParallelEStep):
+                estep.close()
+        return counts
+
+    def _posterior_inputs(self, sequence, scaled):
         """
+        runs the forward and backward passes used by train
+        returns forward probs, backward probs, the value eta/xi divide by, the per-step scales and the convergence value
+        """
+        if scaled:
+            forward_probs, scales = self.forward_scaled(sequence)
+            backward_probs = self.backward_scaled(sequence, scales)
+            with np.errstate(divide="ignore"):
+                log_val = np.sum(np.log(scales))
+            return forward_probs, backward_probs, 1.0, scales, log_val
         forward_probs, forward_val = self.forward(sequence)
+        backward_probs, _ = self.backward(sequence)
+        return forward_probs, backward_probs, forward_val, None, forward_val
+
+    def train(self, sequence, iterations=1000, end=False, scaled=False, tol=0.0000001, workers=None):
+        """
+        tunes the transition and emission matrices so the model is maximally like the observed data
+        scaled=True runs the E-step on normalized forward/backward values and checks convergence
+        on the log-likelihood, so whole songs (or many songs joined together) do not underflow
+        a single sequence returns xi summed over time [state, next_state] and eta [state, time];
+        a list of sequences is trained with pooled (scaled) Baum-Welch and returns the last expected counts;
+        workers > 1 runs its E-step in that many processes
+        """
+        if len(sequence) > 0 and np.ndim(sequence[0]) > 0:
+            return self._train_batch(sequence, iterations, end, tol, workers)
+        forward_probs, backward_probs, forward_val, scales, fit_val = self._posterior_inputs(sequence, scaled)
         for _ in range(iterations):
-            backward_probs, backward_val = self.backward(sequence)
             eta_probs = self.eta(forward_probs, backward_probs, forward_val, sequence)
-            xi_probs = self.xi(forward_probs, backward_probs, forward_val, sequence)
+            xi_sums = self.xi(forward_probs, backward_probs, forward_val, sequence, scales, summed=True)
 
             # recalculate transitions and emissions
-            E = np.zeros(self.E.shape)
-            T = np.zeros(self.T.shape)
-            for i in self.true_states:
-                state_prob = sum(eta_probs[i])
-                T[0, i] = eta_probs[i, 0]
-                val = eta_probs[i, -1]
-                if val == 0:
-                    T[i, -1] = 0
-                elif state_prob == 0:
-                    T[i, -1] = 1
-                else:
-                    T[i, -1] = val / state_prob
-                for j in range(len(self.true_states) - 1):
-                    val = sum(xi_probs[i, :, j])
-                    if val == 0:
-                        T[i, j] = 0
-                    elif state_prob == 0:
-                        T[i, j] = 1
-                    else:
-                        T[i, j] = val / state_prob
-            for i in range(len(self.true_states)):
-                for j in range(len(self.observable_states)):
-                    # get eta sums
-                    idxs = [idx for idx, val in enumerate(sequence) if val == self.observable_states[j]]
-
-                    eta_sum_numerator = np.sum(eta_probs[i, idxs])
-                    eta_sum_denominator = np.sum(eta_probs[i, :])
-                    if eta_sum_denominator != 0:
-                        E[i, j] = eta_sum_numerator / eta_sum_denominator
-                    else:
-                        E[i, j] = 0
+            # (state values double as row indices, and row 0 / the last column hold the
+            # start / end probabilities, exactly as in the original per-cell update)
+            state_probs = np.sum(eta_probs, axis=1)
+            T = self._ratio(xi_sums, state_probs[:, None])
+            T[:, -1] = self._ratio(eta_probs[:, -1], state_probs)
+            T[0, self.true_states[1:]] = eta_probs[self.true_states[1:], 0]
+            E = np.divide(self._emission_counts(sequence, eta_probs), state_probs[:, None],
+                          out=np.zeros(self.E.shape), where=state_probs[:, None] != 0)
             if end:
                 T[self.true_states[-1], self.true_states[-1]] = 1
             self.E = E
             self.T = T
             print("-----------------------")
             print("Update Iteration Complete")
-            temp_forward_val = copy.copy(forward_val)
-            forward_probs, forward_val = self.forward(sequence)
-            diff = np.abs(forward_val - temp_forward_val)
-            if diff <= 0.0000001:
+            temp_fit_val = copy.copy(fit_val)
+            forward_probs, backward_probs, forward_val, scales, fit_val = self._posterior_inputs(sequence, scaled)
+            diff = np.abs(fit_val - temp_fit_val)
+            if diff <= tol:
                 break
-        return xi_probs, eta_probs
+        return xi_sums, eta_probs
 
 
-    def predict_algorithm(self, obs):
-        # Step 2: Initialize Variables
-        predict_table = [
-            [0.0 for _ in range(len(self.true_states))] for _ in range(len(obs))
-        ]
-        backpointer = [
-            [0 for _ in range(len(self.true_states))] for _ in range(len(obs))
-        ]
-
-        # Step 3: Calculate Probabilities
-        for t in range(len(obs)):
-            for s in range(len(self.true_states)):
-                if t == 0:
-                    predict_table[t][s] = self.start_probs[s] * self.E[s][obs[t]]
-                else:
-                    max_prob = max(
-                        predict_table[t - 1][prev_s] * self.T[prev_s][s]
-                        for prev_s in range(len(self.true_states))
-                    )
-                    predict_table[t][s] = max_prob * self.E[s][obs[t]]
-                    backpointer[t][s] = max(
-                        range(len(self.true_states)),
-                        key=lambda prev_s: predict_table[t - 1][prev_s]
-                        * self.T[prev_s][s],
-                    )
-
-        # Step 4: Traceback and Find Best Path
-        best_path_prob = max(predict_table[-1])
-        best_path_pointer = max(
-            range(len(self.true_states)), key=lambda s: predict_table[-1][s]
-        )
-        best_path = [best_path_pointer]
-        for t in range(len(obs) - 1, 0, -1):
-            best_path.insert(0, backpointer[t][best_path[0]])
-
-        # Step 5: Return Best Path
-        return np.array(best_path)
-    
-    def predict_chords(self, observations, top_n=3):
-        # Initialize variables
+    def _log_emissions(self, obs):
+        """
+        log emission probabilities of every state for an array of observation (emission column) indices
+        returns an array shaped obs.shape + [state] (log 0 = -inf)
+        """
+        obs = np.asarray(obs)
+        columns = self.E[:, obs.ravel()]
+        if self.is_sparse:
+            columns = columns.toarray()
+        with np.errstate(divide="ignore"):
+            return np.log(columns).T.reshape(obs.shape + (-1,))
+
+    def _log_transitions_from(self, states):
+        """
+        log transition probabilities out of the given states, shaped [state, next_state]
+        """
+        rows = self.T[states]
+        if self.is_sparse:
+            rows = rows.toarray()
+        with np.errstate(divide="ignore"):
+            return np.log(rows)
+
+    def _log_predecessors(self):
+        """
+        log transition probabilities into every state, laid out [state, prev_slot] for decoding
+        dense models use every state as a predecessor, so the slot is the previous state and prev_states is None
+        sparse models only list each state's nonzero predecessors, padded with -inf to the largest in-degree,
+        so a decoding step costs about one score per stored transition rather than per state pair
+        returns prev_states [state, prev_slot] (or None) and the log probabilities [state, prev_slot]
+        """
+        with np.errstate(divide="ignore"):
+            if not self.is_sparse:
+                return None, np.ascontiguousarray(np.log(self.T).T)
+            # column j of the CSC form holds the predecessors of state j
+            by_state = self.T.tocsc()
+            # sorted predecessors break ties between equal scores towards the lowest state, as the dense layout does
+            by_state.sort_indices()
+            n_states = by_state.shape[1]
+            counts = np.diff(by_state.indptr)
+            width = max(counts.max(initial=0), 1)
+            # gathering predecessors costs several times a dense broadcast, so a state with many
+            # predecessors (a hub chord) makes the dense layout faster even for a sparse model
+            if 4 * width > n_states:
+                return None, np.ascontiguousarray(np.log(by_state.toarray()).T)
+            states = np.repeat(np.arange(n_states), counts)
+            slots = np.arange(by_state.nnz) - np.repeat(by_state.indptr[:-1], counts)
+            prev_states = np.zeros((n_states, width), dtype=int)
+            prev_states[states, slots] = by_state.indices
+            log_T = np.full(prev_states.shape, -np.inf)
+            log_T[states, slots] = np.log(by_state.data)
+            return prev_states, log_T
+
+    def decode(self, obs, mode="viterbi", top_n=3, rng=None):
+        """
+        finds a state index path for a sequence of observation (emission column) indices, in log space
+        mode="viterbi": exact most likely path
+        mode="beam": viterbi that only keeps the top_n best states at each step (approximate, cheaper for small top_n)
+        mode="sample": viterbi where each state's predecessor is drawn uniformly from its top_n candidates
+        rng is a np.random.Generator (or a seed) so sampled paths are reproducible
+        """
+        obs = np.asarray(obs)
+        if mode == "beam":
+            return self._decode_beam(obs, top_n)
+        return self.decode_batch([obs], mode, top_n, rng)[0]
+
+    @staticmethod
+    def _choose_predecessors(scores, mode, k, rng):
+        """
+        picks a predecessor for every [sequence, state] from scores[sequence, state, prev_state]
+        "viterbi" takes the best one, "sample" a uniformly drawn one of the k best
+        returns the chosen predecessors and their scores
+        """
+        best = np.argmax(scores, axis=2)
+        best_scores = np.take_along_axis(scores, best[:, :, None], axis=2)[:, :, 0]
+        if mode == "viterbi" or k == 1:
+            return best, best_scores
+        # walk down the k best predecessors with repeated argmax (cheaper than a partition for small k)
+        picks = rng.integers(k, size=best.shape)
+        chosen, chosen_scores = best.copy(), best_scores.copy()
+        for rank in range(1, k):
+            np.put_along_axis(scores, best[:, :, None], -np.inf, axis=2)
+            best = np.argmax(scores, axis=2)
+            best_scores = np.take_along_axis(scores, best[:, :, None], axis=2)[:, :, 0]
+            chosen = np.where(picks == rank, best, chosen)
+            chosen_scores = np.where(picks == rank, best_scores, chosen_scores)
+        return chosen, chosen_scores
+
+    @staticmethod
+    def _viterbi_step(delta, prev_states, log_T_by_state, mode, k, rng):
+        """
+        one decoding step for score vectors delta[sequence, state] (see _log_predecessors for the layouts)
+        returns the chosen previous state of every [sequence, state] and its score, before the emissions are added
+        """
+        # scores[sequence, state, prev_slot], laid out so predecessors are contiguous
+        if prev_states is None:
+            scores = delta[:, None, :] + log_T_by_state
+        else:
+            scores = delta[:, prev_states] + log_T_by_state
+        slots, step = HiddenMarkovModel._choose_predecessors(scores, mode, k, rng)
+        pointers = slots if prev_states is None else prev_states[np.arange(len(prev_states)), slots]
+        # a state no path reaches has only -inf candidates, and argmax then picks slot 0, which is a
+        # different state in the dense and sparse layouts; point it at the best previous state instead
+        dead = np.isneginf(step)
+        if dead.any():
+            pointers = np.where(dead, np.argmax(delta, axis=1)[:, None], pointers)
+        return pointers, step
+
+    def decode_batch(self, sequences, mode="viterbi", top_n=3, rng=None, batch_size=32):
+        """
+        decodes many observation sequences at once, stepping through time for a whole padded batch together
+        supports the "viterbi" and "sample" modes of decode ("beam" falls back to one sequence at a time)
+        batch_size bounds memory: each step builds a [sequence, state, prev_state] score array
+        returns a list with one state index path per sequence
+        """
+        if mode == "beam":
+            return [self.decode(seq, mode, top_n) for seq in sequences]
+        if mode not in ("viterbi", "sample"):
+            raise ValueError(f"Unknown decoding mode: {mode}")
+        rng = np.random.default_rng(rng)
+        with np.errstate(divide="ignore"):
+            log_start = np.log(self.start_probs)
+        prev_states, log_T_by_state = self._log_predecessors()
         n_states = len(self.true_states)
-        n_observations = len(observations)
-        delta = np.zeros((n_states, n_observations))
-        psi = np.zeros((n_states, n_observations), dtype=int)
-
-        # Initialization step
-        delta[:, 0] = self.start_probs * self.E[:, observations[0]]
-
-        # Recursion step
-        for t in range(1, n_observations):
-            for j in range(n_states):
-                # Calculate probabilities for top-N states
-                top_n_probs = delta[:, t-1] * self.T[:, j] * self.E[j, observations[t]]
-                # Select top-N states
-                top_n_states = np.argsort(top_n_probs)[::-1][:top_n]
-                # Randomly select one state from the top-N states
-                selected_state = np.random.choice(top_n_states)
-                delta[j, t] = top_n_probs[selected_state]
-                psi[j, t] = selected_state
-
-        # Termination step
-        p_max = np.max(delta[:, -1])
-        q_star = np.argmax(delta[:, -1])
-
-        # Backtracking
-        states = [q_star]
-        for t in range(n_observations - 1, 0, -1):
-            states.insert(0, psi[states[0], t])
+        k = min(top_n, log_T_by_state.shape[1])
+        # batch sequences of similar length together so little work goes into padding
+        order = np.argsort([len(seq) for seq in sequences], kind="stable")
+        paths = [None] * len(sequences)
+        for first in range(0, len(sequences), batch_size):
+            members = order[first:first + batch_size]
+            chunk = [np.asarray(sequences[i]) for i in members]
+            lengths = np.array([len(seq) for seq in chunk])
+            obs = np.zeros((len(chunk), lengths.max()), dtype=int)
+            obs[np.arange(lengths.max()) < lengths[:, None]] = np.concatenate(chunk)
 
+            log_emissions = self._log_emissions(obs)
+            delta = log_start + log_emissions[:, 0]
+            psi = np.zeros((len(chunk), lengths.max(), n_states), dtype=int)
+            for t in range(1, lengths.max()):
+                psi[:, t], step = self._viterbi_step(delta, prev_states, log_T_by_state, mode, k, rng)
+                step = step + log_emissions[:, t]
+                # finished sequences keep their final scores
+                delta = np.where((t < lengths)[:, None], step, delta)
+
+            # backtrack every sequence from the best state at its own last step
+            path = np.zeros(obs.shape, dtype=int)
+            path[np.arange(len(chunk)), lengths - 1] = np.argmax(delta, axis=1)
+            for t in range(lengths.max() - 1, 0, -1):
+                live = t < lengths
+                path[live, t - 1] = psi[live, t, path[live, t]]
+            for i, length, member in zip(range(len(chunk)), lengths, members):
+                paths[member] = path[i, :length]
+        return paths
+
+    def _decode_beam(self, obs, width):
+        """
+        viterbi pruned to the width best states per step: only kept states are extended at the next step
+        """
+        log_emissions = self._log_emissions(obs)
+        with np.errstate(divide="ignore"):
+            scores = np.log(self.start_probs) + log_emissions[0]
+        beam = np.argsort(-scores, kind="stable")[:width]
+        beam_scores = scores[beam]
+        states = [beam]
+        parents = []
+        for t in range(1, len(obs)):
+            # candidates[slot, state] of extending each kept state by every state
+            candidates = beam_scores[:, None] + self._log_transitions_from(beam) + log_emissions[t]
+            best_slot = np.argmax(candidates, axis=0)
+            best_scores = candidates[best_slot, np.arange(candidates.shape[1])]
+            beam = np.argsort(-best_scores, kind="stable")[:width]
+            beam_scores = best_scores[beam]
+            parents.append(best_slot[beam])
+            states.append(beam)
+
+        # follow the parent slots back from the best kept state
+        slot = 0
+        path = np.zeros(len(obs), dtype=int)
+        for t in range(len(obs) - 1, -1, -1):
+            path[t] = states[t][slot]
+            if t > 0:
+                slot = parents[t - 1][slot]
+        return path
+
+    def predict_algorithm(self, obs):
+        """
+        most likely state index path (exact viterbi)
+        """
+        return self.decode(obs, mode="viterbi")
+
+    def predict_chords(self, observations, top_n=3, rng=None):
+        """
+        samples a likely chord path, choosing each state's predecessor at random among its top_n candidates
+        """
+        states = self.decode(observations, mode="sample", top_n=top_n, rng=rng)
         # Map state indices to true states (chords)
-        predicted_chords = [self.true_states[state] for state in states]
+        return [self.true_states[state] for state in states]
+
+
+class FixedLagDecoder:
+    """
+    online viterbi over a stream of observations: each state is decided lag steps after its observation arrives
+    memory stays constant however long the stream runs (one score vector plus lag back-pointer vectors)
+    lag=0 gives the best state given the observations so far; larger lags get closer to the full viterbi path,
+    and a lag covering the whole stream reproduces it
+    mode and top_n work as in decode ("viterbi" or "sample")
+    """
+
+    def __init__(self, model, lag=4, mode="viterbi", top_n=3, rng=None):
+        if mode not in ("viterbi", "sample"):
+            raise ValueError(f"Unknown decoding mode: {mode}")
+        self.model = model
+        self.lag = lag
+        self.mode = mode
+        self.rng = np.random.default_rng(rng)
+        with np.errstate(divide="ignore"):
+            self.log_start = np.log(model.start_probs)
+        self.prev_states, self.log_T_by_state = model._log_predecessors()
+        self.k = min(top_n, self.log_T_by_state.shape[1])
+        self.reset()
 
-        return predicted_chords
\ No newline at end of file
+    def reset(self):
+        """
+        forgets the stream so far, ready for a new one
+        """
+        self.delta = None
+        self.back_pointers = deque(maxlen=self.lag)
+
+    def push(self, obs):
+        """
+        adds one observation (emission column index)
+        returns the state index decided for the observation lag steps back, or None until lag + 1 have arrived
+        """
+        log_emissions = self.model._log_emissions([obs])[0]
+        if self.delta is None:
+            self.delta = self.log_start + log_emissions
+        else:
+            # the decode_batch step for a batch of one stream
+            pointers, step = HiddenMarkovModel._viterbi_step(self.delta[None], self.prev_states, self.log_T_by_state,
+                                                             self.mode, self.k, self.rng)
+            # the oldest back pointers drop out of the deque once they are older than lag
+            self.back_pointers.append(pointers[0])
+            self.delta = step[0] + log_emissions
+        # only differences between scores matter, so shifting them keeps long streams from drifting to -inf
+        best = np.max(self.delta)
+        if np.isfinite(best):
+            self.delta = self.delta - best
+        if len(self.back_pointers) == self.lag:
+            return self._backtrack()[0]
+        return None
+
+    def flush(self):
+        """
+        ends the stream: returns the states not decided yet (the last lag or fewer) and resets the decoder
+        """
+        if self.delta is None:
+            return []
+        path = self._backtrack()
+        # the first state of a full window was already returned by the last push
+        undecided = path[1:] if len(self.back_pointers) == self.lag else path
+        self.reset()
+        return undecided
+
+    def _backtrack(self):
+        """
+        follows the back pointers from the current best state, oldest state of the window first
+        """
+        state = int(np.argmax(self.delta))
+        path = [state]
+        for pointers in reversed(self.back_pointers):
+            state = int(pointers[state])
+            path.append(state)
+        return path[::-1]
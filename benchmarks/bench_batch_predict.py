@@ -0,0 +1,56 @@
+"""Throughput of batched chord prediction (predict_chords_utils.get_chord_sequences).
+
+Run from the repository root:
+    python benchmarks/bench_batch_predict.py --melodies 2000
+
+Random melodies of 8-32 notes are built from note pairs seen in the corpus, so every pair maps to an
+observation id. Reports melodies per second for the batched path and for calling
+get_chord_sequence-style decoding one melody at a time on the same model.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import predict_chords_utils as pcu
+
+
+def random_melodies(count, rng):
+    pairs = list(pcu.pair_to_map)
+    melodies = []
+    for _ in range(count):
+        chosen = rng.choice(len(pairs), size=rng.integers(4, 17))
+        notes = [note for i in chosen for note in pairs[i]]
+        durations = list(rng.choice([0.25, 0.5, 1.0], size=len(notes)))
+        melodies.append((notes, durations))
+    return melodies
+
+
+def main(count, seed):
+    rng = np.random.default_rng(seed)
+    melodies = random_melodies(count, rng)
+    hmm = pcu.get_model()
+
+    start = time.perf_counter()
+    pcu.get_chord_sequences(melodies, rng=seed, hmm=hmm)
+    batched = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for notes, durations in melodies:
+        pairs, _ = pcu.get_pairs(list(pcu.standardize_octave(np.array(notes))), durations)
+        hmm.predict_chords([pcu.pair_to_map[pair] for pair in pairs], rng=seed)
+    single = time.perf_counter() - start
+
+    print(f"batched:    {count / batched:8.0f} melodies/s ({batched:.3f} s for {count})")
+    print(f"one by one: {count / single:8.0f} melodies/s ({single:.3f} s for {count})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--melodies", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args.melodies, args.seed)
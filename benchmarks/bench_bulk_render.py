@@ -0,0 +1,49 @@
+"""Rendering throughput of bulk_render.render_batch against Masterpiece.render (midiutil).
+
+Run from the repository root:
+    python benchmarks/bench_bulk_render.py --songs 2000
+
+Random melodies are harmonized once, then rendered both ways. Checks that every file is byte for byte
+identical and reports files per minute on one core.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bulk_render
+import predict_chords_utils as pcu
+from bench_batch_predict import random_melodies
+from masterpiece import Masterpiece
+
+
+def main(count, seed):
+    settings = bulk_render.load_render_settings()
+    melodies = random_melodies(count, np.random.default_rng(seed))
+    results = pcu.get_chord_sequences(melodies, rng=seed)
+    all_rules = [bulk_render.song_rules(notes, durations, result["chords"], result["chord_durations"], settings)
+                 for (notes, durations), result in zip(melodies, results)]
+
+    start = time.perf_counter()
+    expected = [Masterpiece(rules=rules, length=settings["length"], tempo=settings["tempo"]).render()
+                for rules in all_rules]
+    midiutil = time.perf_counter() - start
+
+    start = time.perf_counter()
+    files = bulk_render.render_batch(all_rules, length=settings["length"], tempo=settings["tempo"])
+    batched = time.perf_counter() - start
+
+    assert files == expected, "bulk rendering differs from Masterpiece.render"
+    print(f"midiutil:  {60 * count / midiutil:10.0f} files/min ({midiutil:.3f} s for {count})")
+    print(f"batched:   {60 * count / batched:10.0f} files/min ({batched:.3f} s for {count})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--songs", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args.songs, args.seed)
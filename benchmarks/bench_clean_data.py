@@ -0,0 +1,43 @@
+"""Scaling of the cleaning stage in clean_data/data_pickling.py on synthetic corpora.
+
+Run from the repository root:
+    python benchmarks/bench_clean_data.py --scales 1 10 100
+
+A synthetic corpus at scale k repeats every extracted piece k times (so the 100x corpus holds 6,500 pieces).
+Reports the time of clean_data and join_pieces at each scale; linear-time code keeps the time per piece flat.
+"""
+import argparse
+import os
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.join(BASE_DIR, "clean_data"))
+import data_pickling
+
+
+def main(scales):
+    chords, notes = data_pickling.load_extracted_data()
+    print(f"{'scale':>6} {'pieces':>7} {'clean_data':>11} {'join_pieces':>12} {'us/piece':>9}")
+    for scale in scales:
+        scaled_chords = [list(piece) for _ in range(scale) for piece in chords]
+        scaled_notes = [list(piece) for _ in range(scale) for piece in notes]
+
+        start = time.perf_counter()
+        piece_chords, piece_notes = data_pickling.clean_data(scaled_chords, scaled_notes)
+        cleaned = time.perf_counter() - start
+
+        start = time.perf_counter()
+        data_pickling.join_pieces(piece_chords)
+        data_pickling.join_pieces(piece_notes)
+        joined = time.perf_counter() - start
+
+        per_piece = (cleaned + joined) / len(scaled_chords) * 1e6
+        print(f"{scale:>5}x {len(scaled_chords):>7} {cleaned:>10.3f}s {joined:>11.3f}s {per_piece:>9.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100])
+    main(parser.parse_args().scales)
@@ -0,0 +1,36 @@
+"""Cold-start cost of importing predict_chords_utils.
+
+Run from the repository root:
+    python benchmarks/bench_import.py
+
+Each measurement runs in a fresh interpreter. Reports the wall time of the import alone, the
+import with numpy already loaded (the module's own cost), and warm_up() (loading the artifacts and
+building the model) on top of that.
+"""
+import os
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SNIPPETS = {
+    "import": "import predict_chords_utils",
+    "import (numpy preloaded)": "import numpy\nstart = time.perf_counter()\nimport predict_chords_utils",
+    "warm_up()": "import predict_chords_utils\nstart = time.perf_counter()\npredict_chords_utils.warm_up()",
+}
+
+
+def measure(snippet, repeats):
+    code = "import time\nstart = time.perf_counter()\n" + snippet + "\nprint(time.perf_counter() - start)"
+    runs = [float(subprocess.run([sys.executable, "-c", code], cwd=BASE_DIR, capture_output=True, text=True,
+                                 check=True).stdout) for _ in range(repeats)]
+    return min(runs)
+
+
+def main(repeats=5):
+    for name, snippet in SNIPPETS.items():
+        print(f"{name:26s} {measure(snippet, repeats) * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Load test of the harmonize service (harmonize_service.py) over localhost.
+
+Run from the repository root:
+    python benchmarks/bench_service.py --requests 2000 --clients 64
+
+Starts the service in this process on a free port, then keeps the given number of clients each sending
+harmonize requests over its own keep-alive connection. Reports requests per second and the service's
+own /stats (mean batch size and latency percentiles).
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import harmonize_service
+from bench_batch_predict import random_melodies
+
+
+async def request(reader, writer, method, path, payload=None):
+    body = b"" if payload is None else json.dumps(payload).encode()
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        name, _, value = line.decode().partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return status, await reader.readexactly(int(headers["content-length"]))
+
+
+async def client(port, melodies, path, statuses):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for notes, durations in melodies:
+        status, _ = await request(reader, writer, "POST", path,
+                                  {"notes": [int(n) for n in notes], "durations": [float(d) for d in durations]})
+        statuses.append(status)
+    writer.close()
+
+
+async def main(count, clients, midi, seed):
+    melodies = random_melodies(count, np.random.default_rng(seed))
+    service = harmonize_service.HarmonizeService(rng=seed)
+    server = await harmonize_service.serve(service, port=0)
+    port = server.sockets[0].getsockname()[1]
+    path = "/harmonize.mid" if midi else "/harmonize"
+
+    statuses = []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(port, melodies[i::clients], path, statuses) for i in range(clients)))
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    _, stats = await request(reader, writer, "GET", "/stats")
+    writer.close()
+    server.close()
+    await service.stop()
+    print(f"{path}: {count / elapsed:8.0f} requests/s with {clients} clients "
+          f"({statuses.count(200)} ok of {len(statuses)})")
+    print(json.dumps(json.loads(stats), indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--midi", action="store_true", help="request rendered MIDI files instead of chord JSON")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.clients, args.midi, args.seed))
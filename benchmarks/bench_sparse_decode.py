@@ -0,0 +1,79 @@
+"""Memory and decoding speed of a pruned, sparse HMM against its dense counterpart (HiddenMarkovModel.prune).
+
+Run from the repository root:
+    python benchmarks/bench_sparse_decode.py --states 2000 --top-k 10
+
+A random model with the given number of chord states (and 1.5x as many note pairs) stands in for an
+expanded chord vocabulary. Both models keep the same top_k entries per row, so they decode to the same paths;
+only the storage differs. Checks that the dense and sparse models agree (batch Viterbi and FixedLagDecoder
+streams), and that a FixedLagDecoder whose lag covers the whole stream reproduces decode.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from HMM import FixedLagDecoder, HiddenMarkovModel
+
+
+def random_model(n_states, n_obs, rng):
+    transitions = rng.random((n_states, n_states))
+    transitions /= transitions.sum(axis=1, keepdims=True)
+    emissions = rng.random((n_states, n_obs))
+    emissions /= emissions.sum(axis=1, keepdims=True)
+    return HiddenMarkovModel(np.arange(n_states), np.arange(n_obs), transitions, emissions,
+                             np.full(n_states, 1 / n_states), np.zeros(n_states))
+
+
+def nbytes(model):
+    if model.is_sparse:
+        return sum(m.data.nbytes + m.indices.nbytes + m.indptr.nbytes for m in (model.T, model.E))
+    return model.T.nbytes + model.E.nbytes
+
+
+def stream(model, sequence, lag):
+    decoder = FixedLagDecoder(model, lag=lag)
+    path = [state for obs in sequence for state in [decoder.push(obs)] if state is not None]
+    return path + decoder.flush()
+
+
+def main(n_states, top_k, count, seed, lag):
+    rng = np.random.default_rng(seed)
+    model = random_model(n_states, n_states * 3 // 2, rng)
+    sequences = [rng.integers(model.E.shape[1], size=rng.integers(8, 33)) for _ in range(count)]
+
+    paths = {}
+    for name, pruned in (("dense", model.prune(top_k=top_k, sparse=False)), ("sparse", model.prune(top_k=top_k))):
+        start = time.perf_counter()
+        viterbi = pruned.decode_batch(sequences)
+        decode = time.perf_counter() - start
+        start = time.perf_counter()
+        for seq in sequences:
+            pruned.forward(seq)
+        forward = time.perf_counter() - start
+        start = time.perf_counter()
+        streams = [stream(pruned, seq, lag) for seq in sequences]
+        streamed = time.perf_counter() - start
+        print(f"{name:6s}  T+E {nbytes(pruned) / 1e6:8.2f} MB   viterbi {decode:7.3f} s   forward {forward:7.3f} s"
+              f"   lag-{lag} stream {streamed:7.3f} s")
+
+        # a lag covering the whole stream is the full viterbi path
+        assert all(stream(pruned, seq, len(seq)) == path.tolist() for seq, path in zip(sequences, viterbi)), \
+            f"{name}: full-lag streams differ from decode"
+        paths[name] = ([path.tolist() for path in viterbi], streams)
+
+    assert paths["dense"] == paths["sparse"], "dense and sparse pruned models decode differently"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--states", type=int, default=2000)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--sequences", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--lag", type=int, default=3, help="lag of the FixedLagDecoder streams")
+    args = parser.parse_args()
+    main(args.states, args.top_k, args.sequences, args.seed, args.lag)
@@ -0,0 +1,475 @@
+"""Bulk MIDI rendering: harmonizes and renders whole directories of melodies to MIDI files.
+
+Run from the repository root:
+    python bulk_render.py melodies/ track_outputs/ --workers 4
+
+Every melody is a JSON file {"notes": [...], "durations": [...]}, written out as a .mid file of the same name.
+
+Rendering skips midiutil's per-event objects. The melody and chord tracks are built as NumPy event arrays
+(tick, sort order, insertion order, status, data bytes) and encoded straight into SMF track chunks. The output is
+byte for byte the file Masterpiece.render writes for the same rules.
+"""
+import argparse
+import glob
+import json
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from chord_voicings import load_voicings
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TRACK_FILES_PATH = os.path.join(BASE_DIR, "track_generation_files")
+
+# midiutil's defaults, which Masterpiece uses
+TICKS_PER_QUARTER = 960
+NUM_TRACKS = 3
+
+# midiutil's secondary sort order for events at the same tick: controllers, then note offs, then note ons
+CONTROLLER, NOTE_OFF, NOTE_ON = 1, 2, 3
+STATUS = {CONTROLLER: 0xB0, NOTE_OFF: 0x80, NOTE_ON: 0x90}
+SUSTAIN_PEDAL = 64
+END_OF_TRACK = b"\x00\xff\x2f\x00"
+
+# render settings, loaded once per process
+_settings = None
+
+
+def load_render_settings():
+    """load the chord voicings, song settings and note velocities used to render MIDI files
+
+    Returns:
+        dict : voicings (VoicingTable of the chord vocabulary), length, tempo and velocity
+    """
+    voicings = load_voicings()
+    with open(os.path.join(TRACK_FILES_PATH, "song_settings.json"), "r") as f:
+        params = json.load(f)
+    with open(os.path.join(TRACK_FILES_PATH, "rules.json"), "r") as f:
+        velocity = json.load(f)["velocity"]
+    return {"voicings": voicings, "length": params["length"], "tempo": params["tempo"],
+            "velocity": velocity}
+
+
+def _to_ticks(beats):
+    # midiutil truncates every time and duration to whole ticks separately
+    return (np.asarray(beats, dtype=np.float64) * TICKS_PER_QUARTER).astype(np.int64)
+
+
+def _padded_starts(rows):
+    """
+    start time of every item of ragged rows of durations, as a running sum per row
+    returns the durations and start times of all rows flattened, and the row of each item
+    the sum runs along a zero-padded [row, item] array, so each start is the same float as adding the
+    durations one by one in Python
+    """
+    lengths = np.array([len(row) for row in rows], dtype=np.int64)
+    live = np.arange(max(lengths.max(initial=0), 1)) < lengths[:, None]
+    padded = np.zeros(live.shape)
+    padded[live] = np.concatenate([[]] + [np.asarray(row, dtype=np.float64) for row in rows])
+    starts = np.concatenate([np.zeros((len(rows), 1)), np.cumsum(padded, axis=1)[:, :-1]], axis=1)
+    return padded[live], starts[live], np.nonzero(live)[0]
+
+
+def _events(song, tick, sort, order, status, data1, data2):
+    return {"song": song, "tick": tick, "sort": np.full(tick.shape, sort), "order": order,
+            "status": np.full(tick.shape, status), "data1": data1, "data2": data2}
+
+
+def _concat(parts):
+    return {key: np.concatenate([np.asarray(part[key], dtype=np.int64) for part in parts]) for key in parts[0]}
+
+
+def _note_events(song, start, duration, pitch, velocity, order):
+    """note on and note off events for notes starting at start (beats) and lasting duration (beats)"""
+    on = _to_ticks(start)
+    off = on + _to_ticks(duration)
+    return [_events(song, on, NOTE_ON, order, STATUS[NOTE_ON], pitch, velocity),
+            _events(song, off, NOTE_OFF, order, STATUS[NOTE_OFF], pitch, velocity)]
+
+
+def _pedal_events(song, time, value, order):
+    """sustain pedal controller events at time (beats)"""
+    tick = _to_ticks(time)
+    return _events(song, tick, CONTROLLER, order, STATUS[CONTROLLER], np.full(tick.shape, SUSTAIN_PEDAL), value)
+
+
+def melody_events(melodies, length, velocities):
+    """event arrays of the melody tracks of many songs, as Masterpiece.create_melody_track adds them
+
+    Args:
+        melodies (list) : (notes, rhythm) per song, rhythm being a list of phrases of note durations in beats
+        length (int) : number of times each melody is repeated
+        velocities (list) : strong, intermediate and weak note velocities per song
+
+    Returns:
+        dict : event arrays (song, tick, sort, order, status, data1, data2)
+    """
+    # every phrase is zipped with the notes, so the shorter of the two sets the number of notes
+    pitch = np.concatenate([[]] + [notes[:len(phrase)] for notes, rhythm in melodies
+                                   for _ in range(length) for phrase in rhythm]).astype(np.int64)
+    duration, pos, song = _padded_starts([[d for _ in range(length) for phrase in rhythm for d in phrase[:len(notes)]]
+                                          for notes, rhythm in melodies])
+    strong, intermediate, weak = (np.array([velocity[key] for velocity in velocities], dtype=np.int64)[song]
+                                  for key in ("strong", "intermediate", "weak"))
+    relative_pos = pos - np.floor(pos / 4) * 4
+    volume = np.where((0 <= relative_pos) & (relative_pos < 1), strong,
+                      np.where((2 <= relative_pos) & (relative_pos < 3), intermediate, weak))
+    # the pedal goes down with every note on beat 1 or 3 and comes up just before the next one
+    pedal = (relative_pos == 0) | (relative_pos == 2)
+
+    # insertion order: each note, then its two pedal events
+    counts = 1 + 2 * pedal
+    order = np.cumsum(counts) - counts
+    return _concat(_note_events(song, pos, duration, pitch, volume, order) + [
+        _pedal_events(song[pedal], pos[pedal], np.full(pedal.sum(), 127), order[pedal] + 1),
+        _pedal_events(song[pedal], pos[pedal] + 1.96875, np.zeros(pedal.sum()), order[pedal] + 2),
+    ])
+
+
+def chord_events(progressions):
+    """event arrays of the chord tracks of many songs, as Masterpiece.create_chord_track adds them
+
+    Args:
+        progressions (list) : (seq_chord, chord_rhythm) per song: MIDI notes and duration in beats of each chord
+
+    Returns:
+        dict : event arrays (song, tick, sort, order, status, data1, data2)
+    """
+    progressions = [(seq_chord[:len(chord_rhythm)], chord_rhythm[:len(seq_chord)])
+                    for seq_chord, chord_rhythm in progressions]
+    rhythm, pos, song = _padded_starts([chord_rhythm for _, chord_rhythm in progressions])
+    sizes = np.array([len(chord) for seq_chord, _ in progressions for chord in seq_chord], dtype=np.int64)
+    pitch = np.array([pitch for seq_chord, _ in progressions for chord in seq_chord for pitch in chord],
+                     dtype=np.int64)
+    start, duration, song = np.repeat(pos, sizes), np.repeat(rhythm, sizes), np.repeat(song, sizes)
+
+    # insertion order: pedal down, pedal up, then the note, for every pitch of every chord
+    order = 3 * np.arange(len(pitch))
+    return _concat(_note_events(song, start, duration, pitch, np.full(len(pitch), 76), order + 2) + [
+        _pedal_events(song, start, np.full(len(pitch), 127), order),
+        _pedal_events(song, start + duration - 0.03125, np.zeros(len(pitch)), order + 1),
+    ])
+
+
+def _sort_events(events):
+    """sort events by song, then (tick, sort order, insertion order) like midiutil's sort_events"""
+    order = np.lexsort((events["order"], events["sort"], events["tick"], events["song"]))
+    return {key: values[order] for key, values in events.items()}
+
+
+def _remove_duplicate_notes(events):
+    """drop note ons (and note offs) repeating the song, tick and pitch of an earlier one, as midiutil does"""
+    keep = np.ones(len(events["tick"]), dtype=bool)
+    for kind in (NOTE_ON, NOTE_OFF):
+        index = np.flatnonzero(events["sort"] == kind)
+        if len(index):
+            # earliest insertion first, so the first of each duplicate group is the one kept
+            index = index[np.argsort(events["order"][index], kind="stable")]
+            # one integer per (song, tick, pitch)
+            keys = (events["song"][index] * (events["tick"].max() + 1) + events["tick"][index]) * 128 \
+                + events["data1"][index]
+            _, first = np.unique(keys, return_index=True)
+            keep[index] = False
+            keep[index[first]] = True
+    return {key: values[keep] for key, values in events.items()}
+
+
+def _deinterleave(events):
+    """
+    midiutil's note de-interleaving: a note off for a pitch that is sounding more than once is moved to the
+    latest note on of that pitch. Only overlapping notes of the same pitch are affected, so the
+    per-event loop only runs for batches that have them.
+    """
+    notes = np.flatnonzero(events["sort"] != CONTROLLER)
+    by_pitch = notes[np.lexsort((events["sort"][notes] == NOTE_ON, events["tick"][notes],
+                                 events["data1"][notes], events["song"][notes]))]
+    song, pitch, kind = events["song"][by_pitch], events["data1"][by_pitch], events["sort"][by_pitch]
+    # when every note on is followed directly by a note off of the same song and pitch, no notes overlap;
+    # anything else (two ons in a row, unmatched offs) needs the exact stack walk
+    if len(kind) % 2 == 0 and (kind[0::2] == NOTE_ON).all() and (kind[1::2] == NOTE_OFF).all() \
+            and (pitch[0::2] == pitch[1::2]).all() and (song[0::2] == song[1::2]).all():
+        return events
+
+    tick = events["tick"].copy()
+    stack = {}
+    for i in notes:
+        key = (events["song"][i], events["data1"][i])
+        if events["sort"][i] == NOTE_ON:
+            stack.setdefault(key, []).append(tick[i])
+        elif len(stack[key]) > 1:
+            tick[i] = stack[key].pop()
+        else:
+            stack[key].pop()
+    return _sort_events(dict(events, tick=tick))
+
+
+def _vlq_columns(values):
+    """
+    splits non-negative ints into MIDI variable length quantities
+    returns the four possible bytes per value (most significant first) and a mask of the ones used
+    """
+    groups = np.stack([(values >> shift) & 0x7F for shift in (21, 14, 7, 0)], axis=1)
+    groups[:, :3] |= 0x80
+    length = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+    used = np.arange(4)[None, :] >= 4 - length[:, None]
+    return groups, used
+
+
+def _vlq(value):
+    groups, used = _vlq_columns(np.array([value], dtype=np.int64))
+    return bytes(groups[used].astype(np.uint8))
+
+
+def _chunk(data):
+    return b"MTrk" + struct.pack(">L", len(data) + len(END_OF_TRACK)) + data + END_OF_TRACK
+
+
+def encode_tracks(events, n_songs, name, program=0):
+    """encode the event arrays of one track of many songs into one SMF track chunk per song
+
+    Args:
+        events (dict) : event arrays from melody_events or chord_events
+        n_songs (int) : number of songs in the batch
+        name (str) : track name
+        program (int) : General MIDI program of channel 0
+
+    Returns:
+        list : the MTrk chunk of every song
+    """
+    events = _deinterleave(_sort_events(_remove_duplicate_notes(events)))
+    # track name and program change sort before every channel event at tick 0
+    encoded_name = name.encode("ISO-8859-1")
+    header = b"\x00\xff\x03" + _vlq(len(encoded_name)) + encoded_name + bytes([0x00, 0xC0, program])
+
+    # delta times restart at the first event of every song
+    song = events["song"]
+    delta = np.diff(events["tick"], prepend=0)
+    first = np.r_[True, song[1:] != song[:-1]] if len(song) else np.zeros(0, dtype=bool)
+    delta[first] = events["tick"][first]
+    vlq, used = _vlq_columns(delta)
+    columns = np.concatenate([vlq, np.stack([events["status"], events["data1"], events["data2"]], axis=1)], axis=1)
+    mask = np.concatenate([used, np.ones((len(delta), 3), dtype=bool)], axis=1)
+    data = columns[mask].astype(np.uint8).tobytes()
+
+    # byte range of every song in the encoded stream
+    event_bytes = np.bincount(song, weights=used.sum(axis=1) + 3, minlength=n_songs).astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(event_bytes)])
+    return [_chunk(header + data[offsets[i]:offsets[i + 1]]) for i in range(n_songs)]
+
+
+def render_batch(all_rules, length=4, tempo=90, melody=True, chord=True):
+    """render many songs' rules (the rules.json layout) to MIDI file bytes in one set of array operations
+
+    Args:
+        all_rules (list) : rules of every song: notes, rhythm, seq_chord, chord_rhythm and velocity
+        length (int) : number of times each melody is repeated
+        tempo (int) : tempo in beats per minute
+        melody (bool) : include the melody tracks
+        chord (bool) : include the chord tracks
+
+    Returns:
+        list : the MIDI file of every song, each identical to Masterpiece.render for its rules
+    """
+    tracks = []
+    if melody:
+        events = melody_events([(rules["notes"], rules["rhythm"]) for rules in all_rules], length,
+                               [rules["velocity"] for rules in all_rules])
+        tracks.append(encode_tracks(events, len(all_rules), "piano"))
+    if chord:
+        events = chord_events([(rules["seq_chord"], rules["chord_rhythm"]) for rules in all_rules])
+        tracks.append(encode_tracks(events, len(all_rules), "chords"))
+    # format 1: a tempo track first, then the instrument tracks, unused ones left empty
+    tempo_track = _chunk(b"\x00\xff\x51\x03" + struct.pack(">L", int(60000000 / tempo))[1:] if tracks else b"")
+    empty_tracks = _chunk(b"") * (NUM_TRACKS - len(tracks))
+    header = b"MThd" + struct.pack(">LHHH", 6, 1, NUM_TRACKS + 1, TICKS_PER_QUARTER)
+    return [header + tempo_track + b"".join(song_tracks) + empty_tracks
+            for song_tracks in zip(*tracks)] if tracks else [header + tempo_track + empty_tracks] * len(all_rules)
+
+
+def render(rules, length=4, tempo=90, melody=True, chord=True):
+    """render one song's rules (the rules.json layout) to MIDI file bytes, identical to Masterpiece.render
+
+    Args:
+        rules (dict) : notes, rhythm, seq_chord, chord_rhythm and velocity
+        length (int) : number of times the melody is repeated
+        tempo (int) : tempo in beats per minute
+        melody (bool) : include the melody track
+        chord (bool) : include the chord track
+
+    Returns:
+        bytes : the MIDI file
+    """
+    return render_batch([rules], length, tempo, melody, chord)[0]
+
+
+def song_rules(notes, durations, chords, chord_durations, settings):
+    """rules (the rules.json layout) of a harmonized melody, the same way generate_midi_files.generate_midi builds them
+
+    Every chord of the vocabulary has a voicing in the compiled table, so seq_chord stays aligned with chord_rhythm.
+
+    Args:
+        notes (list) : MIDI notes of the melody
+        durations (list) : durations of the notes in beats
+        chords (list) : chord names
+        chord_durations (list) : durations of the chords in beats
+        settings (dict) : render settings from load_render_settings
+
+    Returns:
+        dict : notes, rhythm, chord_rhythm, seq_chord and velocity
+    """
+    return {
+        "notes": notes,
+        "rhythm": [durations],
+        "chord_rhythm": chord_durations,
+        "seq_chord": settings["voicings"].voicings(chords),
+        "velocity": settings["velocity"],
+    }
+
+
+def render_song(notes, durations, chords, chord_durations, settings):
+    """render a harmonized melody to MIDI file bytes (see song_rules)
+
+    Returns:
+        bytes : the MIDI file
+    """
+    rules = song_rules(notes, durations, chords, chord_durations, settings)
+    return render(rules, length=settings["length"], tempo=settings["tempo"])
+
+
+def read_melody(path):
+    """read and check one melody JSON file
+
+    Args:
+        path (str) : melody JSON file ({"notes": [...], "durations": [...]})
+
+    Returns:
+        tuple : (notes, durations)
+    """
+    import predict_chords_utils as pcu
+
+    with open(path, "r") as f:
+        melody = json.load(f)
+    notes = [int(note) for note in melody["notes"]]
+    durations = [float(duration) for duration in melody["durations"]]
+    if len(notes) != len(durations) or len(notes) < 2:
+        raise ValueError("notes and durations must have the same length, at least 2")
+    if not all(np.isfinite(duration) and duration > 0 for duration in durations):
+        raise ValueError("durations must be finite and positive")
+    pairs, _ = pcu.get_pairs(list(pcu.standardize_octave(np.array(notes))), durations)
+    unknown = [pair for pair in pairs if pair not in pcu.pair_to_map]
+    if unknown:
+        raise KeyError(f"note pairs not in the vocabulary: {[tuple(int(n) for n in pair) for pair in unknown]}")
+    return notes, durations
+
+
+def _harmonize_and_render(melodies, seed):
+    import predict_chords_utils as pcu
+
+    results = pcu.get_chord_sequences(melodies, rng=seed)
+    all_rules = [song_rules(notes, durations, result["chords"], result["chord_durations"], _settings)
+                 for (notes, durations), result in zip(melodies, results)]
+    return render_batch(all_rules, length=_settings["length"], tempo=_settings["tempo"])
+
+
+def _init_worker(settings):
+    global _settings
+    _settings = settings
+
+
+def render_files(paths, output_dir, seed=None):
+    """harmonize a group of melody files together and write one MIDI file per melody (runs in pool workers)
+
+    A file that cannot be read, harmonized or rendered is reported and skipped; the rest of the group is still written.
+
+    Args:
+        paths (list) : melody JSON files
+        output_dir (str) : folder the .mid files are written to
+        seed (int, optional) : seed for reproducible chords
+
+    Returns:
+        tuple : number of files written, and (path, error) for every file that failed
+    """
+    global _settings
+    if _settings is None:
+        _settings = load_render_settings()
+
+    failures = []
+    good_paths = []
+    melodies = []
+    for path in paths:
+        try:
+            melodies.append(read_melody(path))
+            good_paths.append(path)
+        except Exception as e:
+            failures.append((path, f"{type(e).__name__}: {e}"))
+
+    try:
+        files = _harmonize_and_render(melodies, seed) if melodies else []
+    except Exception:
+        # one melody the checks let through must not cost the others, so the group is retried one file at a time
+        files = []
+        for path, melody in zip(good_paths, melodies):
+            try:
+                files.extend(_harmonize_and_render([melody], seed))
+            except Exception as e:
+                failures.append((path, f"{type(e).__name__}: {e}"))
+                files.append(None)
+
+    written = 0
+    for path, midi in zip(good_paths, files):
+        if midi is None:
+            continue
+        name = os.path.splitext(os.path.basename(path))[0] + ".mid"
+        with open(os.path.join(output_dir, name), "wb") as f:
+            f.write(midi)
+        written += 1
+    return written, failures
+
+
+def render_directory(input_dir, output_dir, workers=None, chunk_size=256, seed=None):
+    """harmonize and render every melody JSON file in a folder, spread over a process pool
+
+    Failing files are printed and skipped, like mxlconverter's failed scores, so one bad melody does not stop the run.
+
+    Args:
+        input_dir (str) : folder of melody JSON files
+        output_dir (str) : folder the .mid files are written to (created if missing)
+        workers (int, optional) : number of processes, one per CPU if not given
+        chunk_size (int) : melodies each worker harmonizes in one batch
+        seed (int, optional) : seed for reproducible chords (each chunk gets seed + its index)
+
+    Returns:
+        tuple : number of files written, and (path, error) for every file that failed
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = sorted(glob.glob(os.path.join(input_dir, "*.json")))
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    seeds = [None if seed is None else seed + i for i in range(len(chunks))]
+    # the settings (and the voicing table, rebuilt here if its cache is stale) are loaded once and handed to
+    # every worker, so workers never write the shared cache file
+    settings = load_render_settings()
+    if workers == 1:
+        _init_worker(settings)
+        results = [render_files(chunk, output_dir, chunk_seed) for chunk, chunk_seed in zip(chunks, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(settings,)) as pool:
+            results = list(pool.map(render_files, chunks, [output_dir] * len(chunks), seeds))
+    written = sum(count for count, _ in results)
+    failures = [failure for _, chunk_failures in results for failure in chunk_failures]
+    for path, error in failures:
+        print(f"Failed to render {path}: {error}")
+    return written, failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Harmonize and render a folder of melodies to MIDI files")
+    parser.add_argument("input_dir", help="folder of melody JSON files ({\"notes\": [...], \"durations\": [...]})")
+    parser.add_argument("output_dir", help="folder the .mid files are written to")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes (default: one per CPU)")
+    parser.add_argument("--chunk-size", type=int, default=256, help="melodies harmonized together per batch")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    count, failures = render_directory(args.input_dir, args.output_dir, args.workers, args.chunk_size, args.seed)
+    print(f"Rendered {count} files to {args.output_dir}, {len(failures)} failed")
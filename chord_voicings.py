@@ -0,0 +1,196 @@
+"""Compiled chord voicing table: the MIDI notes of every chord in the HMM's vocabulary, indexed by chord id.
+
+The table is built once from the chord vocabulary (map_to_chords) and cached in
+track_generation_files/chord_voicings.npz, so rendering a chord is an array lookup rather than a JSON or
+music21 call. Every chord gets a voicing: the curated one from chord_to_notes.json when it has one, otherwise
+music21's harmony.ChordSymbol spelling (as in clean_data/mxlconverter.convert_to_int).
+
+Run this module directly to rebuild the cache.
+"""
+import json
+import os
+import re
+import tempfile
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TRACK_FILES_PATH = os.path.join(BASE_DIR, "track_generation_files")
+CHORD_TO_NOTES_PATH = os.path.join(TRACK_FILES_PATH, "chord_to_notes.json")
+VOICINGS_PATH = os.path.join(TRACK_FILES_PATH, "chord_voicings.npz")
+
+# music21 spells chords around octave 2; they are moved up so the lowest note lands in C4-B4, like the curated voicings
+LOWEST_NOTE = 60
+ROOT = re.compile(r"^[A-G][#-]*")
+
+
+def _raise_to_octave(pitches):
+    return [p + 12 * ((LOWEST_NOTE - min(pitches) + 11) // 12) for p in pitches]
+
+
+def voice_chord(name, chord_to_notes=None):
+    """MIDI notes of one chord name
+
+    Chords not in chord_to_notes are spelled with music21's ChordSymbol. A name music21 cannot read falls back
+    to the major triad on its root, and a name without a readable root to a rest ([]).
+
+    Args:
+        name (str) : chord name, in the music21 spelling of the chord vocabulary (e.g. "B-m7")
+        chord_to_notes (dict, optional) : chord name -> curated MIDI notes
+
+    Returns:
+        list : MIDI notes of the chord
+    """
+    if chord_to_notes and name in chord_to_notes:
+        return list(chord_to_notes[name])
+    from music21 import harmony, pitch
+
+    try:
+        pitches = [p.midi for p in harmony.ChordSymbol(name).pitches]
+    except Exception:
+        pitches = []
+    if not pitches:
+        root = ROOT.match(name)
+        if root is None:
+            return []
+        try:
+            base = pitch.Pitch(root.group()).pitchClass
+        except Exception:
+            return []
+        pitches = [base, base + 4, base + 7]
+    return _raise_to_octave(pitches)
+
+
+def load_chord_to_notes(path=CHORD_TO_NOTES_PATH):
+    """read the curated voicings of chord_to_notes.json as a chord name -> MIDI notes dict"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return {chord: info["midi_notes"] for chord, info in json.load(f).items()}
+
+
+class VoicingTable:
+    """voicings of a chord vocabulary, indexed by chord id
+
+    notes is an (n_chords, width) int16 array padded with -1 and sizes the number of notes of each chord, the form
+    that is cached. The voicings are also kept as ready-made lists, so a lookup by id or name costs one index.
+    """
+
+    def __init__(self, chords, notes, sizes):
+        """
+        Args:
+            chords (list) : chord names in id order
+            notes (np.ndarray) : (n_chords, width) MIDI notes, padded with -1
+            sizes (np.ndarray) : number of notes of each chord
+        """
+        self.chords = list(chords)
+        self.notes = np.asarray(notes, dtype=np.int16).reshape(len(self.chords), -1)
+        self.sizes = np.asarray(sizes, dtype=np.int16)
+        self.index = {chord: i for i, chord in enumerate(self.chords)}
+        self._voicings = [row[:size] for row, size in zip(self.notes.tolist(), self.sizes.tolist())]
+
+    @classmethod
+    def build(cls, chords, chord_to_notes=None):
+        """voice every chord of a vocabulary
+
+        Args:
+            chords (list) : chord names in id order
+            chord_to_notes (dict, optional) : chord name -> curated MIDI notes, read from chord_to_notes.json if not given
+
+        Returns:
+            VoicingTable : the table
+        """
+        if chord_to_notes is None:
+            chord_to_notes = load_chord_to_notes()
+        voicings = [voice_chord(chord, chord_to_notes) for chord in chords]
+        sizes = np.array([len(voicing) for voicing in voicings], dtype=np.int16)
+        notes = np.full((len(voicings), max(sizes, default=0)), -1, dtype=np.int16)
+        for row, voicing in zip(notes, voicings):
+            row[:len(voicing)] = voicing
+        return cls(chords, notes, sizes)
+
+    @classmethod
+    def load(cls, chords, path=VOICINGS_PATH, chord_to_notes_path=CHORD_TO_NOTES_PATH):
+        """read the cached table for a chord vocabulary, building and caching whatever it is missing
+
+        The chord vocabulary is append-only, so a cache whose chords are a prefix of chords only needs the new
+        chords voiced. The whole table is rebuilt if the vocabulary differs otherwise or chord_to_notes.json is
+        newer than the cache.
+
+        Args:
+            chords (list) : chord names in id order (e.g. the values of map_to_chords)
+            path (str) : cache file
+            chord_to_notes_path (str) : curated voicings
+
+        Returns:
+            VoicingTable : the table, covering every chord
+        """
+        chords = list(chords)
+        table = None
+        if os.path.exists(path) and (not os.path.exists(chord_to_notes_path)
+                                     or os.path.getmtime(chord_to_notes_path) <= os.path.getmtime(path)):
+            with np.load(path) as data:
+                table = cls(data["chords"].tolist(), data["notes"], data["sizes"])
+            if table.chords == chords:
+                return table
+            if table.chords != chords[:len(table.chords)]:
+                table = None
+
+        chord_to_notes = load_chord_to_notes(chord_to_notes_path)
+        if table is None:
+            table = cls.build(chords, chord_to_notes)
+        else:
+            table = table.concatenate(cls.build(chords[len(table.chords):], chord_to_notes))
+        table.save(path)
+        return table
+
+    def save(self, path=VOICINGS_PATH):
+        """write the table to one uncompressed .npz file
+
+        The file is written next to path and moved into place in one step, so a process loading the cache while
+        another one rebuilds it never reads a half-written file.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, chords=np.array(self.chords, dtype=str), notes=self.notes, sizes=self.sizes)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def concatenate(self, other):
+        """the table with the chords of another one appended"""
+        width = max(self.notes.shape[1], other.notes.shape[1])
+        notes = np.full((len(self) + len(other), width), -1, dtype=np.int16)
+        notes[:len(self), :self.notes.shape[1]] = self.notes
+        notes[len(self):, :other.notes.shape[1]] = other.notes
+        return VoicingTable(self.chords + other.chords, notes, np.concatenate([self.sizes, other.sizes]))
+
+    def __len__(self):
+        return len(self.chords)
+
+    def __getitem__(self, chord_id):
+        """MIDI notes of the chord with this id"""
+        return self._voicings[chord_id]
+
+    def voicing(self, chord):
+        """MIDI notes of a chord name (KeyError if it is not in the vocabulary)"""
+        return self._voicings[self.index[chord]]
+
+    def voicings(self, chords):
+        """MIDI notes of each of a sequence of chord names"""
+        return [self._voicings[self.index[chord]] for chord in chords]
+
+
+def load_voicings(path=VOICINGS_PATH):
+    """voicing table of the chord vocabulary the HMM decodes to (predict_chords_utils' map_to_chords)"""
+    import predict_chords_utils as pcu
+
+    map_to_chords = pcu.load_artifacts()["map_to_chords"]
+    return VoicingTable.load([map_to_chords[i] for i in range(len(map_to_chords))], path)
+
+
+if __name__ == "__main__":
+    table = load_voicings()
+    print(f"Voiced {len(table)} chords into {VOICINGS_PATH}")
@@ -0,0 +1,136 @@
+import os
+
+import numpy as np
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus.npz")
+
+
+def _offsets(lengths):
+    """
+    Turns a list of lengths into offsets, so item i spans offsets[i]:offsets[i + 1].
+    """
+    return np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+
+
+class Corpus:
+    """
+    Columnar, array-backed corpus stored once in clean_data/corpus.npz.
+
+    Melody columns (one entry per note or rest of the extracted lead sheets, before cleaning; data_pickling.clean_data
+    reads each piece's melody from these):
+    - pitch: MIDI pitch, -1 for rests
+    - duration: length in beats
+    - measure_id: index of the measure the note is in, over the whole corpus
+    - piece_id: index of the piece the note is in
+    - measure_offsets: notes of measure m are measure_offsets[m]:measure_offsets[m + 1]
+    - piece_measure_offsets: measures of piece p are piece_measure_offsets[p]:piece_measure_offsets[p + 1]
+
+    Training sequence columns (one entry per cleaned note pair / chord):
+    - pair_id: integer id of the note pair
+    - chord_id: integer id of the chord
+    - sequence_offsets: the sequence of piece p is sequence_offsets[p]:sequence_offsets[p + 1]
+
+    Everything handed out by the accessors is a view into these arrays, never a copy.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    @classmethod
+    def from_notes(cls, notes):
+        """
+        Builds the melody columns from the nested note lists; the training sequence columns are added later
+        with add_sequences, once the melody has been cleaned.
+
+        Parameters:
+        - notes (list): For each piece, a list of measures, each a list of (MIDI pitch, duration) tuples.
+
+        Returns:
+        - corpus (Corpus): The columnar corpus, melody columns only.
+        """
+        measures = [measure for piece in notes for measure in piece]
+        flat_notes = [note for measure in measures for note in measure]
+        measure_lengths = [len(measure) for measure in measures]
+        piece_measure_offsets = _offsets([len(piece) for piece in notes])
+        measure_id = np.repeat(np.arange(len(measures), dtype=np.int32), measure_lengths)
+        measure_piece = np.repeat(np.arange(len(notes), dtype=np.int32), np.diff(piece_measure_offsets))
+        return cls({
+            "pitch": np.array([pitch for pitch, _ in flat_notes], dtype=np.int16),
+            "duration": np.array([float(duration) for _, duration in flat_notes], dtype=np.float64),
+            "measure_id": measure_id,
+            "piece_id": measure_piece[measure_id],
+            "measure_offsets": _offsets(measure_lengths),
+            "piece_measure_offsets": piece_measure_offsets,
+        })
+
+    def add_sequences(self, pair_ids, chord_ids):
+        """
+        Adds the training sequence columns.
+
+        Parameters:
+        - pair_ids (list): For each piece, its list of note pair ids.
+        - chord_ids (list): For each piece, its list of chord ids (same lengths as pair_ids).
+        """
+        self.arrays["pair_id"] = np.array([pair for piece in pair_ids for pair in piece], dtype=np.int32)
+        self.arrays["chord_id"] = np.array([chord for piece in chord_ids for chord in piece], dtype=np.int32)
+        self.arrays["sequence_offsets"] = _offsets([len(piece) for piece in pair_ids])
+
+    @classmethod
+    def from_lists(cls, notes, pair_ids, chord_ids):
+        """
+        Builds the columns from the nested list representations.
+
+        Parameters:
+        - notes (list): For each piece, a list of measures, each a list of (MIDI pitch, duration) tuples.
+        - pair_ids (list): For each piece, its list of note pair ids.
+        - chord_ids (list): For each piece, its list of chord ids (same lengths as pair_ids).
+
+        Returns:
+        - corpus (Corpus): The columnar corpus.
+        """
+        corpus = cls.from_notes(notes)
+        corpus.add_sequences(pair_ids, chord_ids)
+        return corpus
+
+    def save(self, path=CORPUS_PATH):
+        """
+        Writes every column to one uncompressed .npz file.
+        """
+        np.savez(path, **self.arrays)
+
+    @classmethod
+    def load(cls, path=CORPUS_PATH):
+        """
+        Reads a corpus saved with save.
+        """
+        with np.load(path) as data:
+            return cls({name: data[name] for name in data.files})
+
+    def __len__(self):
+        return len(self.arrays["piece_measure_offsets"]) - 1
+
+    def pieces(self, column):
+        """
+        Splits a training sequence column ("pair_id" or "chord_id") into one view per piece.
+        """
+        offsets = self.arrays["sequence_offsets"]
+        return [self.arrays[column][offsets[i]:offsets[i + 1]] for i in range(len(self))]
+
+    def piece_notes(self, piece):
+        """
+        Gets the pitch and duration views of every note of one piece, plus its measure offsets
+        (relative to the piece's first note).
+        """
+        first, last = self.arrays["piece_measure_offsets"][piece:piece + 2]
+        measure_offsets = self.arrays["measure_offsets"][first:last + 1]
+        notes = slice(measure_offsets[0], measure_offsets[-1])
+        return self.arrays["pitch"][notes], self.arrays["duration"][notes], measure_offsets - measure_offsets[0]
+
+    def measures(self, piece):
+        """
+        Gets one list of (pitch, duration) tuples per measure of one piece, the nested form used by data_pickling.
+        """
+        pitch, duration, offsets = self.piece_notes(piece)
+        return [list(zip(pitch[offsets[m]:offsets[m + 1]].tolist(), duration[offsets[m]:offsets[m + 1]].tolist()))
+                for m in range(len(offsets) - 1)]
+
@@ -1,87 +1,171 @@
+import os
 import pickle
 import json
 import numpy as np
 from HMM import HiddenMarkovModel as hmm
 from collections import Counter
-import random
+from itertools import chain
+from corpus import Corpus
+from vocabulary import CHORD_VOCAB_PATH, PAIR_VOCAB_PATH, Vocabulary
 
-# Unpickle chord and note data made from mxlconverter.py
-with open("chord_data.pkl", "rb") as infile:
-    chords = pickle.load(infile)
-    # Remove pieces with too much missing information
-    chords.pop(43)
-    chords.pop(30)
+CLEAN_DATA_PATH = os.path.dirname(os.path.abspath(__file__))
 
-with open("note_rest_data.pkl", "rb") as infile:
-    notes = pickle.load(infile)
-    # Remove pieces with too much missing information
-    notes.pop(43)
-    notes.pop(30)
 
+# Pieces with too much missing information, left out of training
+EXCLUDED_PIECES = ("All Blues", "Freedom Jazz Song")
 
-def get_beats_per_chord(num_chords, beats_per_measure):
+
+def load_extracted_data(folder=CLEAN_DATA_PATH, excluded=EXCLUDED_PIECES):
     """
-    Determines the distribution of beats per chord within a measure based on the number of chords and beats per measure.
+    Unpickles the chord and note data made from mxlconverter.py, without the excluded pieces.
+
+    Parameters:
+    - folder (str): The folder holding chord_data.pkl, note_rest_data.pkl and song_names.txt.
+    - excluded (tuple): Names of the pieces to leave out.
+
+    Returns:
+    - chords (list): Chords per measure for each piece.
+    - notes (list): (MIDI pitch, duration) tuples per measure for each piece.
+    """
+    with open(os.path.join(folder, "chord_data.pkl"), "rb") as infile:
+        chords = pickle.load(infile)
+    with open(os.path.join(folder, "note_rest_data.pkl"), "rb") as infile:
+        notes = pickle.load(infile)
+    # The names are written next to the pickles in the same piece order, so pieces are dropped by name
+    with open(os.path.join(folder, "song_names.txt"), "r") as infile:
+        names = infile.read().splitlines()
+    if len(names) != len(chords) or len(names) != len(notes):
+        raise ValueError("song_names.txt does not match the pickled pieces, re-run mxlconverter.py --save")
+    kept = [i for i, name in enumerate(names) if name not in excluded]
+    return [chords[i] for i in kept], [notes[i] for i in kept]
+
+
+# Finest subdivision of the beat that chord changes are placed on
+BEAT_SUBDIVISIONS = (1, 0.5, 0.25)
+
+
+def allocate_beats(num_chords, beats_per_measure):
+    """
+    Distributes the beats of a measure over its chords for any meter and chord count.
+
+    The measure is cut into the coarsest grid of whole beats (or halves, or quarters of a beat) that has at
+    least one slot per chord; the slots are shared out evenly and any leftover slots go to the earliest chords,
+    which fall on the stronger beats (e.g. 4 beats over 3 chords gives [2, 1, 1]). Measures that do not fit any
+    grid are split evenly.
 
     Parameters:
     - num_chords (int): The number of chords in the measure.
-    - beats_per_measure (int): The total number of beats in the measure.
+    - beats_per_measure (float): The total number of beats in the measure.
 
     Returns:
-    - beats_per_chord (list): A list representing the distribution of beats per chord within the measure.
+    - beats_per_chord (list): The number of beats for each chord, or None if the measure has no beats to share.
     """
     # If there is only one chord, assign all beats to it
     if num_chords == 1:
         return [beats_per_measure]
-    elif beats_per_measure == 4:
-        # Distribute beats evenly for four chords
-        if num_chords == 4:
-            return [1, 1, 1, 1]
-        # Distribute beats as 2, 1, 1 for three chords
-        elif num_chords == 3:
-            return [2, 1, 1]
-        # Distribute beats evenly for two chords
-        elif num_chords == 2:
-            return [2, 2]
-    elif beats_per_measure == 3:
-        # Distribute beats evenly for three chords
-        if num_chords == 3:
-            return [1, 1, 1]
-        # Distribute beats as 2, 1 for two chords
-        elif num_chords == 2:
-            return [2, 1]
-    elif beats_per_measure == 8:
-        # Distribute beats evenly for eight chords
-        if num_chords == 8:
-            return [1] * 8
-        # Distribute beats evenly for four chords
-        elif num_chords == 4:
-            return [2] * 4
-        # Distribute beats evenly for two chords
-        elif num_chords == 2:
-            return [4, 4]
-    elif beats_per_measure == 2:
-        # Distribute beats evenly for two chords
-        if num_chords == 2:
-            return [1, 1]
-    elif beats_per_measure == 1:
-        # Distribute beats evenly for two chords
-        if num_chords == 2:
-            return [0.5, 0.5]
-    elif beats_per_measure == 6:
-        # Distribute beats evenly for three chords
-        if num_chords == 3:
-            return [2, 2, 2]
-    else:
-        # If no specific pattern matches, print a warning message
-        print('Pattern not specified', beats_per_measure, num_chords)
+    if num_chords < 1 or beats_per_measure <= 0:
         return None
+    for subdivision in BEAT_SUBDIVISIONS:
+        slots = beats_per_measure / subdivision
+        if slots == int(slots) and slots >= num_chords:
+            base, extra = divmod(int(slots), num_chords)
+            return [(base + (i < extra)) * subdivision for i in range(num_chords)]
+    # Off-grid measure: split evenly, with the last chord absorbing the rounding
+    even = round(beats_per_measure / num_chords, 3)
+    return [even] * (num_chords - 1) + [round(beats_per_measure - even * (num_chords - 1), 3)]
+
+
+# Precomputed beat distributions for every common meter (in beats, on a half-beat grid) and chord count
+BEATS_PER_CHORD_TABLE = {
+    (beats / 2, num_chords): allocate_beats(num_chords, beats / 2)
+    for beats in range(1, 25)
+    for num_chords in range(1, 9)
+}
+
+
+def get_beats_per_chord(num_chords, beats_per_measure):
+    """
+    Determines the distribution of beats per chord within a measure based on the number of chords and beats per measure.
+
+    Common meters are answered from BEATS_PER_CHORD_TABLE; anything else is computed with allocate_beats.
+
+    Parameters:
+    - num_chords (int): The number of chords in the measure.
+    - beats_per_measure (int): The total number of beats in the measure.
+
+    Returns:
+    - beats_per_chord (list): A list representing the distribution of beats per chord within the measure.
+    """
+    beats_per_chord = BEATS_PER_CHORD_TABLE.get((beats_per_measure, num_chords))
+    if beats_per_chord is None:
+        return allocate_beats(num_chords, beats_per_measure)
+    return list(beats_per_chord)
+
+
+def segment_notes(pitches, durations, note_measures, chord_beats, chord_measures):
+    """
+    Splits all notes of a piece into groups representing individual chords in one vectorized pass.
+
+    Note and chord boundaries are cumulative-duration arrays, and np.searchsorted finds the first and last chord
+    each note overlaps. A note that runs over a chord change belongs to every chord it sounds in. Note times restart
+    at each measure boundary, so a measure whose notes do not add up exactly does not shift the rest of the piece.
+
+    Parameters:
+    - pitches (array-like): MIDI pitch of every note in the piece, in order.
+    - durations (array-like): Duration in beats of every note.
+    - note_measures (array-like): Index of the measure each note belongs to (non-decreasing, starting at 0).
+    - chord_beats (array-like): Number of beats for every chord in the piece, in order.
+    - chord_measures (array-like): Index of the measure each chord belongs to (non-decreasing, starting at 0).
+
+    Returns:
+    - grouped_pitches (numpy.ndarray): Pitches ordered by chord; a straddling note appears once per chord it overlaps.
+    - chord_offsets (numpy.ndarray): Offsets into grouped_pitches, so chord i holds grouped_pitches[chord_offsets[i]:chord_offsets[i + 1]].
+    """
+    pitches = np.asarray(pitches)
+    durations = np.asarray(durations, dtype=np.float64)
+    note_measures = np.asarray(note_measures, dtype=np.intp)
+    chord_beats = np.asarray(chord_beats, dtype=np.float64)
+    chord_measures = np.asarray(chord_measures, dtype=np.intp)
+    num_chords = len(chord_beats)
+
+    # Chord end times across the whole piece, rounded to avoid floating point errors
+    chord_ends = np.round(np.cumsum(chord_beats), 3)
+    # Start time of every measure, taken from the chord grid
+    measure_lengths = np.bincount(chord_measures, weights=chord_beats)
+    measure_starts = np.concatenate(([0.0], np.cumsum(measure_lengths)[:-1]))
+
+    # Note end times within their measure: running total minus the total at the start of the measure
+    note_ends = np.cumsum(durations)
+    first_note = np.searchsorted(note_measures, np.arange(len(measure_lengths)))
+    before_measure = np.concatenate(([0.0], note_ends))[first_note]
+    note_ends = note_ends - before_measure[note_measures] + measure_starts[note_measures]
+    note_starts = np.round(note_ends - durations, 3)
+    note_ends = np.round(note_ends, 3)
+
+    # First chord sounding at the note's start and last chord sounding before its end
+    first = np.minimum(np.searchsorted(chord_ends, note_starts, side="right"), num_chords - 1)
+    last = np.minimum(np.searchsorted(chord_ends, note_ends, side="left"), num_chords - 1)
+    # Zero-length notes on a boundary still belong to one chord
+    last = np.maximum(last, first)
+
+    # Repeat each note once for every chord it overlaps
+    spans = last - first + 1
+    note_index = np.repeat(np.arange(len(pitches)), spans)
+    span_starts = np.cumsum(spans) - spans
+    chord_index = first[note_index] + np.arange(len(note_index)) - span_starts[note_index]
+
+    # Stable sort keeps notes in time order within each chord
+    order = np.argsort(chord_index, kind="stable")
+    chord_offsets = np.concatenate(([0], np.cumsum(np.bincount(chord_index, minlength=num_chords))))
+    return pitches[note_index[order]], chord_offsets
 
 
 def split_notes_by_chord(notes, beats_per_chord):
     """
     Splits a list of notes into groups representing individual chords based on specified beats per chord.
 
+    This is the single-measure form of segment_notes, so a note that runs over a chord change belongs to every chord it overlaps.
+
     Parameters:
     - notes (list): A list of tuples where each tuple contains a MIDI pitch (int) and its duration in beats (float).
     - beats_per_chord (list): A list of floats representing the desired number of beats for each chord.
@@ -89,29 +173,12 @@ def split_notes_by_chord(notes, beats_per_chord):
     Returns:
     - notes_per_chord (list): A list of lists where each inner list contains the MIDI pitches of notes belonging to a chord.
     """
-    # Initializes list for notes for each chord
-    notes_per_chord = []
-    # Initializes list for notes in current chord (inner list)
-    notes_for_chord = []
-    # Initializes a beat total and chord counter
-    beat_tot = 0
-    count = 0
-
-    for n in notes:
-        # Adds note to current chord notes list
-        notes_for_chord.append(n[0])
-        # Adds duration of current note to total beats counter
-        beat_tot += n[1]
-        # Check if beat count matches desired count for the chord
-        if round(beat_tot, 3) == beats_per_chord[count]: # Round to avoid floating point errors
-            # Appends current chord notes to overall list
-            notes_per_chord.append(notes_for_chord)
-            # Resets beat counter and current chord notes list
-            beat_tot = 0
-            notes_for_chord = []
-            # Moves onto next chord
-            count += 1
-    return notes_per_chord
+    pitches = [pitch for pitch, _ in notes]
+    durations = [duration for _, duration in notes]
+    grouped, offsets = segment_notes(pitches, durations, np.zeros(len(notes), dtype=np.intp),
+                                     beats_per_chord, np.zeros(len(beats_per_chord), dtype=np.intp))
+    grouped = grouped.tolist()
+    return [grouped[offsets[i]:offsets[i + 1]] for i in range(len(beats_per_chord))]
 
 
 def clean_notes(notes):
@@ -174,44 +241,48 @@ def clean_data(chords, notes):
 
     Parameters:
     - chords (list): A list of lists where each inner list represents chords for a piece of music.
-    - notes (list): A list of lists where each inner list represents notes for a piece of music.
+    - notes (Corpus or list): The melody of every piece, as the melody columns of a Corpus (nested note lists
+                              are turned into one first).
 
     Returns:
     - all_chords (list): A list of lists where each inner list contains one cleaned chord for a piece of music.
     - all_notes (list): A list of tuples where each tuple represents a note pair corresponding to one chord for a piece of music.
 
     """
+    corpus = notes if isinstance(notes, Corpus) else Corpus.from_notes(notes)
     # Initialize lists to store cleaned chord and note data for all pieces
     all_chords = []
     all_notes = []
 
     # Iterate through each piece
-    for piece in range(len(chords)):
+    for piece, piece_chords in enumerate(chords):
         # Initialize lists to sore cleaned chord and note data for current piece
         cleaned_chords = []
         cleaned_notes = []
 
-        # Remove first measure if there is no chord data (removes measure for notes as well)
-        # usually occurs if the first measure contains a pickup note(s)
-        if chords[piece][0] is False:
-            chords[piece].pop(0)
-            notes[piece].pop(0)
-        # Removes measures where there are no chord data (removes measure for notes as well)
-        if [0] in chords[piece] or [] in chords[piece]:
-            # Find indices of missing chord measure
-            indexes = [i for i, x in enumerate(chords[piece]) if x == [0] or x == []]
-            # Removes given indices
-            for index in sorted(indexes, reverse=True):
-                chords[piece].pop(index)
-                notes[piece].pop(index)
-
-        # Iterates through each measure of the piece
-        for measure in range(len(chords[piece])):
+        # The piece's melody is a set of views into the corpus columns
+        pitches, durations, note_offsets = corpus.piece_notes(piece)
+        note_measures = np.repeat(np.arange(len(note_offsets) - 1), np.diff(note_offsets))
+        # Gets the number of beats in every measure (bincount adds in note order, like a running sum)
+        measure_beats = np.bincount(note_measures, weights=durations, minlength=len(note_offsets) - 1).tolist()
+
+        # Measures that survive validation, segmented together once the whole piece has been scanned
+        kept_chords = []
+        kept_measures = []
+        kept_beats = []
+
+        # Iterates through each measure of the piece in one pass, skipping measures instead of popping them
+        for measure, curr_chords in enumerate(piece_chords[:len(measure_beats)]):
+            # Skip first measure if there is no chord data (skips measure for notes as well)
+            # usually occurs if the first measure contains a pickup note(s)
+            if measure == 0 and curr_chords is False:
+                continue
+            # Skips measures where there are no chord data (skips measure for notes as well)
+            if curr_chords == [0] or curr_chords == []:
+                continue
+
             # Gets the number of beats in the measure
-            beats_per_measure = round(sum([dur for _, dur in notes[piece][measure]]), 3)
-            # Gets chords and notes in current measure
-            curr_chords = chords[piece][measure]
-            curr_notes = notes[piece][measure]
+            beats_per_measure = round(measure_beats[measure], 3)
             # Calculates number of chords in the measure
             num_chords = len(curr_chords)
 
@@ -220,28 +291,40 @@ def clean_data(chords, notes):
             # Skip to next measure if beat distribution pattern is not defined in get_beats_per_chord (only contains most common beat patterns)
             if beats_per_chord is None:
                 continue
-            # Splits notes by chord (list of list of notes)
-            notes_per_chord = split_notes_by_chord(curr_notes, beats_per_chord)
-            
-            # Initializes lists for cleaned notes per chord and the chord itself
-            clean_notes_per_chord = []
-            clean_chords = []
-            for i, notes_pc in enumerate(notes_per_chord):
+            kept_chords.append(curr_chords)
+            kept_measures.append(measure)
+            kept_beats.append(beats_per_chord)
+
+        if kept_chords:
+            # Renumber the kept measures 0..k-1 and select their notes from the piece's columns
+            kept_index = np.full(len(measure_beats), -1)
+            kept_index[kept_measures] = np.arange(len(kept_measures))
+            kept_notes = kept_index[note_measures]
+            mask = kept_notes >= 0
+
+            # Splits every kept note of the piece by chord in one call
+            grouped, offsets = segment_notes(
+                pitches[mask],
+                durations[mask],
+                kept_notes[mask],
+                list(chain.from_iterable(kept_beats)),
+                np.repeat(np.arange(len(kept_beats)), [len(beats) for beats in kept_beats]),
+            )
+            grouped = grouped.tolist()
+
+            for i, chord in enumerate(chain.from_iterable(kept_chords)):
                 # Clean notes for the given notes in the chord
-                clean = clean_notes(notes_pc)
+                clean = clean_notes(grouped[offsets[i]:offsets[i + 1]])
                 if clean == []:
                     continue
-                clean_notes_per_chord.append(clean)
-                clean_chords.append([curr_chords[i]])
-
-            # Add cleaned notes and chords for the current measure to the rest of the cleaned notes
-            cleaned_notes = cleaned_notes + clean_notes_per_chord
-            cleaned_chords = cleaned_chords + clean_chords
+                # Add cleaned notes (as a tuple) and chord for the current measure to the rest of the piece
+                cleaned_notes.append(tuple(clean))
+                cleaned_chords.append([chord])
         # Append cleaned chord and note data for the current piece to the respective lists
         all_chords.append(cleaned_chords)
         all_notes.append(cleaned_notes)
 
-    return all_chords, tuple_notes(all_notes)
+    return all_chords, all_notes
 
 
 def join_pieces(data):
@@ -254,60 +337,69 @@ def join_pieces(data):
     Returns:
     - final (list): A single list containing all the inner lists joined together.
     """
-    final = []
-    for piece in data:
-        final = final + piece
-    return final
+    # Chains the pieces in one pass instead of copying the growing list for every piece
+    return list(chain.from_iterable(data))
 
 
-def get_mapping_dicts(data):
+def get_mapping_dicts(data, vocabulary=None):
     """
     Generates mapping dictionaries between chords/notes and integers.
 
+    Ids come from an append-only Vocabulary: tokens it already knows keep their id, and new tokens are appended
+    in the order they first appear in data, so the same input always gives the same ids.
+
     Parameters:
     - data (list): A list containing chords/notes.
+    - vocabulary (Vocabulary): The vocabulary to extend; a new empty one if not given.
 
     Returns:
     - map_to_pair (dict): A dictionary mapping integers to unique chords/notes.
     - pair_to_map (dict): A dictionary mapping chords/notes to integers.
     """
-    # Get unique elements and shuffle them
-    unique_data = list(set(data))
-    random.shuffle(unique_data)
-    # Create a dictionary mapping integers to unique elements
-    map_to_pair = dict(enumerate(unique_data))
-    # Create a dictionary mapping unique elements to integers
-    pair_to_map = {val: key for key, val in map_to_pair.items()}
-    return map_to_pair, pair_to_map
+    if vocabulary is None:
+        vocabulary = Vocabulary()
+    vocabulary.extend(data)
+    return vocabulary.id_to_token(), vocabulary.token_to_id()
 
 
-def main():
+def main(save=False):
+    chords, notes = load_extracted_data()
+    # Store the melody once as flat columns; cleaning reads every piece from them
+    corpus = Corpus.from_notes(notes)
     # Get cleaned chords and note pairs separated by piece
-    piece_chords, piece_notes = clean_data(chords, notes)
+    piece_chords, piece_notes = clean_data(chords, corpus)
     # Join chords and note pairs from all pieces into one
     separated_chords = join_pieces(piece_chords)
     separated_notes = join_pieces(piece_notes)
 
+    # Load the persisted vocabularies (seeded from the old mapping pickles the first time) so ids stay stable
+    pair_vocab = Vocabulary.load(PAIR_VOCAB_PATH, seed_path=os.path.join(CLEAN_DATA_PATH, 'map_to_pair.pkl'))
+    chord_vocab = Vocabulary.load(CHORD_VOCAB_PATH, seed_path=os.path.join(CLEAN_DATA_PATH, 'map_to_chords.pkl'))
+
     # Generate dictionary mappings for note pairs to integers
-    map_to_pair, pair_to_map = get_mapping_dicts(separated_notes)
-    # Turn piece separated and joined note pairs into integer mappings
-    piece_mapped_notes = [[pair_to_map[pair] for pair in piece] for piece in piece_notes]
-    separated_mapped_notes = join_pieces(piece_mapped_notes)
+    map_to_pair, pair_to_map = get_mapping_dicts(separated_notes, pair_vocab)
+    # Turn piece separated note pairs into integer mappings
+    piece_mapped_notes = [pair_vocab.encode(piece) for piece in piece_notes]
 
     # Generate dictionary mappings for chords to integers
-    map_to_chords, chords_to_map = get_mapping_dicts([lst[0] for lst in separated_chords])
-    # Turn piece separated and joined chords into integer mappings
-    piece_mapped_chords = [[chords_to_map[chord] for chord in piece] for piece in [[c[0] for c in p] for p in piece_chords]]
-    separated_mapped_chords = join_pieces(piece_mapped_chords)
-
-    # Pickle and store cleaned data and mappings
-    # pickles = {'map_to_pair': map_to_pair, 'pair_to_map': pair_to_map, 'piece_mapped_notes': piece_mapped_notes,
-    #            'separated_mapped_notes': separated_mapped_notes, 'map_to_chords': map_to_chords,
-    #            'chords_to_map': chords_to_map,
-    #            'piece_mapped_chords': piece_mapped_chords, 'separated_mapped_chords': separated_mapped_chords}
-    # for name, dict in pickles.items():
-    #     with open(name + '.pkl', 'wb') as f:
-    #         pickle.dump(dict, f)
+    map_to_chords, chords_to_map = get_mapping_dicts([lst[0] for lst in separated_chords], chord_vocab)
+    # Turn piece separated chords into integer mappings
+    piece_mapped_chords = [chord_vocab.encode([c[0] for c in piece]) for piece in piece_chords]
+
+    # Add the training sequences to the corpus; joined and per-piece sequences are both views of it
+    corpus.add_sequences(piece_mapped_notes, piece_mapped_chords)
+
+    # Save the vocabularies, the mapping pickles derived from them, and the corpus
+    if save:
+        pair_vocab.save(PAIR_VOCAB_PATH)
+        chord_vocab.save(CHORD_VOCAB_PATH)
+        pickles = {'map_to_pair': map_to_pair, 'pair_to_map': pair_to_map, 'map_to_chords': map_to_chords,
+                   'chords_to_map': chords_to_map}
+        for name, dict in pickles.items():
+            with open(os.path.join(CLEAN_DATA_PATH, name + '.pkl'), 'wb') as f:
+                pickle.dump(dict, f)
+        corpus.save()
+    return corpus
 
 if __name__ == '__main__':
     main()
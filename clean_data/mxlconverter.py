@@ -1,53 +1,62 @@
 import music21
 from music21 import *
+import argparse
+import hashlib
 import os
-import numpy as np
 import pickle 
+from concurrent.futures import ProcessPoolExecutor
 
-def extract_notes_and_chords_by_measure(mxl_file_path):
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_PATH = os.path.join(BASE_DIR, "data")
+CLEAN_DATA_PATH = os.path.join(BASE_DIR, "clean_data")
+# per-file extraction results, keyed by the hash of each .mxl file's contents
+CACHE_PATH = os.path.join(CLEAN_DATA_PATH, "mxl_cache")
+# bump whenever process_file's output changes, so stale cache entries are ignored
+EXTRACTOR_VERSION = 2
+
+
+def iter_measure_records(mxl_file_path):
     """
-    Gets notes and chords from a MusicXML (MXL) file organized by measure.
+    Yields compact note and chord records from a MusicXML (MXL) file, one measure at a time.
+
+    Only each measure's own elements and voices are looked at (no recursion through the whole measure), and they
+    are converted straight to plain values. The whole score is still parsed up front and stays in memory until
+    the generator is exhausted, so peak memory is that of the parsed score; the gain is that callers get back
+    small tuples and strings rather than music21 objects.
 
     Parameters:
     - mxl_file_path (str): The file path of the MXL file to extract notes and chords from.
 
-    Returns:
-    - notes_by_measure (dict): A dictionary where keys are measure numbers (int) and values are lists of notes and rests
-                               (music21.note.Note or music21.note.Rest objects) occurring in that measure.
-    - chords_by_measure (dict): A dictionary where keys are measure numbers (int) and values are lists of chords
-                                (music21.chord.Chord objects) occurring in that measure.
+    Yields:
+    - measure_number (int): The index of the measure within its part.
+    - notes (list): (MIDI pitch, quarter length) tuples for the notes and rests of the measure, with rests as -1.
+    - chords (list or None): Cleaned chord names (str) for the measure, or None if they could not be converted.
     """
-    try:
-        # Load the MXL file
-        score = converter.parse(mxl_file_path)
-
-        # Initialize dictionary to store notes and chords organized by measure
-        notes_by_measure = {}
-        chords_by_measure = {}
-    # Extract notes, rests, and chords from the score
-        for part in score.parts:
-            # iterate through each measure
-            for measure_number, measure in enumerate(part.getElementsByClass('Measure')):
-                measure_notes = []
-                measure_chords = []
-                for element in measure.recurse():
-                    # add notes and rests to measure_notes, and chords to measure_chords
-                    if isinstance(element, music21.note.Note):
-                        measure_notes.append(element)
-                    elif isinstance(element, music21.note.Rest):
-                        measure_notes.append(element)
-                    elif isinstance(element, music21.chord.Chord):
-                        measure_chords.append(element)
-                # add measure notes, rests, and chords to dictionaries
-                notes_by_measure.setdefault(measure_number, []).extend(measure_notes)
-                chords_by_measure.setdefault(measure_number, []).extend(measure_chords)
-
-        return notes_by_measure, chords_by_measure
-
-    except converter.ConverterException as e:
-        print(f"Error parsing MXL file: {e}")
-        return None, None
-    
+    score = converter.parse(mxl_file_path)
+    for part in score.parts:
+        for measure_number, measure in enumerate(part.getElementsByClass('Measure')):
+            notes = []
+            chords = []
+            elements = list(measure.notesAndRests)
+            for voice in measure.voices:
+                elements.extend(voice.notesAndRests)
+            for element in elements:
+                # chord symbols are chords too, so check for chords before single notes
+                if element.isChord:
+                    chords.append(element)
+                elif element.isRest:
+                    notes.append((-1, element.duration.quarterLength))
+                elif element.isNote:
+                    notes.append((element.pitch.midi, element.duration.quarterLength))
+            try:
+                # Remove extensions, inversions, and added tones from chords
+                chords = remove_extensions(chords)
+            except Exception:
+                # Conversion failed, let the caller decide how to mark the measure
+                chords = None
+            yield measure_number, notes, chords
+
+
 def remove_extensions(chords):
     """
     Remove extensions, inversions, and added tones from chords.
@@ -58,6 +67,7 @@ def remove_extensions(chords):
     Returns:
     - cleaned_chords (list): A list of cleaned chord names (str) without extensions, inversions, and added tones.
     """
+    cleaned_chords = []
     for chord in chords:
         name = chord.figure
         if not name == 'N.C.':
@@ -96,69 +106,116 @@ def convert_to_int(chords):
     return int_pitches
 
 
-def main():
-    folder_path = r'/Users/christinahe/Documents/spring2024/cs4100/project/cs4100-final-proj/data'
+def process_file(file_path):
+    """
+    Extracts the notes and chords of one MusicXML file, measure by measure.
+
+    Parameters:
+    - file_path (str): The file path of the MXL file.
+
+    Returns:
+    - single_song_notes (list): One list of (MIDI pitch, quarter length) tuples per measure, with rests as -1.
+    - single_song_chords (list): One list of cleaned chord names per measure.
+    - error (str or None): A description of the failure if the file could not be processed, otherwise None.
+    """
+    notes_by_measure = {}
+    chords_by_measure = {}
+    failed_measures = set()
+    try:
+        # Collect the compact records measure by measure, merging parts that share a measure number
+        for measure_number, notes, chords in iter_measure_records(file_path):
+            notes_by_measure.setdefault(measure_number, []).extend(notes)
+            if chords is None:
+                failed_measures.add(measure_number)
+                chords = []
+            chords_by_measure.setdefault(measure_number, []).extend(chords)
+    except Exception as e:
+        # Isolate the failure to this file so the rest of the corpus is still processed
+        return [], [], f"{type(e).__name__}: {e}"
+
+    # A score without measures contributes nothing
+    if not notes_by_measure or not chords_by_measure:
+        return [], [], None
+    # If chord conversion fails anywhere in a measure, the whole measure gets the default 0
+    single_song_chords = [[0] if measure_number in failed_measures else chords
+                          for measure_number, chords in chords_by_measure.items()]
+    return list(notes_by_measure.values()), single_song_chords, None
+
+
+def content_key(file_path):
+    """
+    Computes the cache key of a MusicXML file from its contents and the extractor version.
+
+    Parameters:
+    - file_path (str): The file path of the MXL file.
+
+    Returns:
+    - key (str): A hex digest identifying this exact file content.
+    """
+    sha = hashlib.sha256(f"extractor-v{EXTRACTOR_VERSION}".encode())
+    with open(file_path, 'rb') as f:
+        sha.update(f.read())
+    return sha.hexdigest()
+
+
+def main(folder_path=DATA_PATH, workers=None, cache_path=CACHE_PATH, save=False):
     note_data = []
     chord_data = []
-    file_names = np.array([])
-
-    # Iterate through each file in the data folder
-    for filename in os.listdir(folder_path):
-
-        # Construct the full file path
-        file_path = os.path.join(folder_path, filename)
-        # Get the name of each piece and append to array
-        filename_clean = filename.replace('_', ' ').replace('.mxl', '')
-        file_names = np.append(file_names, filename_clean)
-
-        # Initialize lists to store notes and chords for each song
-        single_song_notes = []
-        single_song_chords = []
-
-        # Extract notes and chords organized by measure from the MusicXML file
-        notes_by_measure, chords_by_measure = extract_notes_and_chords_by_measure(file_path)
-
-        if notes_by_measure and chords_by_measure:
-            # Process notes for each measure
-            for _, notes in notes_by_measure.items():
-                try:
-                    # Convert note pitches to MIDI representation and store with duration
-                    int_pitches = []
-                    for note in notes:
-                        if note.isRest:
-                            int_pitches.append((-1, note.duration.quarterLength))
-                        elif note.isNote:
-                            int_pitches.append((note.pitch.midi, note.duration.quarterLength))
-
-                    single_song_notes.append(int_pitches)
-                except:
-                    # If conversion fails, append default 0
-                    note_data.append([[0]])
-                    #print("Failed to convert") 
-            
-            # Process chords for each measure
-            for _, chords in chords_by_measure.items():
-                try:
-                    # Remove extensions, inversions, and added tones from chords
-                    cleaned_chords = remove_extensions(chords)
-                    single_song_chords.append(cleaned_chords)
-                except:
-                     # If conversion fails, append default 0
-                    single_song_chords.append([0])
-                    #print("Failed to convert")
-        
+    file_names = []
+    os.makedirs(cache_path, exist_ok=True)
+
+    # Sorting keeps the piece order stable
+    filenames = sorted(filename for filename in os.listdir(folder_path) if filename.endswith('.mxl'))
+    file_paths = [os.path.join(folder_path, filename) for filename in filenames]
+    keys = [content_key(file_path) for file_path in file_paths]
+    cache_files = [os.path.join(cache_path, key + '.pkl') for key in keys]
+
+    # Only parse scores that are new or changed since they were last cached, across a process pool
+    missing = [i for i, cache_file in enumerate(cache_files) if not os.path.exists(cache_file)]
+    if missing:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # map returns results in input order, whichever worker finishes first
+            results = executor.map(process_file, [file_paths[i] for i in missing], chunksize=1)
+            for i, (single_song_notes, single_song_chords, error) in zip(missing, results):
+                if error is not None:
+                    # Failures are not cached, so the file is retried next time
+                    print(f"Failed to process {filenames[i]}: {error}")
+                    continue
+                with open(cache_files[i], 'wb') as f:
+                    pickle.dump((single_song_notes, single_song_chords), f)
+    print(f"Parsed {len(missing)} of {len(filenames)} files, the rest came from the cache")
+
+    # Reassemble the corpus from the cached entries
+    for filename, cache_file in zip(filenames, cache_files):
+        # Get the name of each piece and append to list
+        file_names.append(filename.replace('_', ' ').replace('.mxl', ''))
+        single_song_notes, single_song_chords = [], []
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                single_song_notes, single_song_chords = pickle.load(f)
         # Append the notes and chords for the current song to the overall data lists
         note_data.append(single_song_notes)
         chord_data.append(single_song_chords)
 
     # Pickle and store data
-    # with open('note_rest_data.pkl', 'wb') as f:
-    #     pickle.dump(note_data, f)
+    if save:
+        with open(os.path.join(CLEAN_DATA_PATH, 'note_rest_data.pkl'), 'wb') as f:
+            pickle.dump(note_data, f)
+
+        with open(os.path.join(CLEAN_DATA_PATH, 'chord_data.pkl'), 'wb') as f:
+            pickle.dump(chord_data, f)
 
-    # with open('chord_data.pkl', 'wb') as f:
-    #     pickle.dump(chord_data, f)
+        # The piece names, in pickle order, let data_pickling exclude pieces by name
+        with open(os.path.join(CLEAN_DATA_PATH, 'song_names.txt'), 'w') as f:
+            f.write('\n'.join(file_names) + '\n')
 
-    # np.savetxt('song_names.txt', file_names)
+    return note_data, chord_data, file_names
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Extract notes and chords from every MusicXML file in data/")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of parsing processes (default: one per CPU)")
+    parser.add_argument("--save", action="store_true",
+                        help="overwrite note_rest_data.pkl, chord_data.pkl and song_names.txt with the extracted corpus")
+    args = parser.parse_args()
+    main(workers=args.workers, save=args.save)
@@ -0,0 +1,133 @@
+import os
+import pickle
+
+import numpy as np
+
+CLEAN_DATA_PATH = os.path.dirname(os.path.abspath(__file__))
+PAIR_VOCAB_PATH = os.path.join(CLEAN_DATA_PATH, "pair_vocab.npz")
+CHORD_VOCAB_PATH = os.path.join(CLEAN_DATA_PATH, "chord_vocab.npz")
+
+
+class Vocabulary:
+    """
+    Persistent, append-only index between tokens (note pairs or chord names) and dense integer ids.
+
+    Ids are positions in the token array: id i always decodes to tokens[i], and new tokens are only ever
+    appended, so an id never changes once it has been handed out. Encoding goes through a dict and decoding
+    through the token array, both O(1) per token.
+    """
+
+    def __init__(self, tokens=()):
+        self.tokens = []
+        self.index = {}
+        self._array = None
+        self.extend(tokens)
+
+    @classmethod
+    def from_mapping(cls, id_to_token):
+        """
+        Builds a vocabulary from an id -> token dict (e.g. map_to_pair.pkl), keeping its ids.
+
+        Parameters:
+        - id_to_token (dict): Mapping from dense ids 0..n-1 to tokens.
+
+        Returns:
+        - vocabulary (Vocabulary): The vocabulary with the same ids.
+        """
+        if sorted(id_to_token) != list(range(len(id_to_token))):
+            raise ValueError("ids must be dense, 0 to n - 1")
+        return cls(id_to_token[i] for i in range(len(id_to_token)))
+
+    @classmethod
+    def load(cls, path, seed_path=None):
+        """
+        Reads a vocabulary saved with save. If there is no file at path yet, seeds it from the id -> token
+        pickle at seed_path so existing ids are preserved, or starts empty.
+
+        Parameters:
+        - path (str): The .npz file written by save.
+        - seed_path (str): Optional id -> token pickle to start from when path does not exist.
+
+        Returns:
+        - vocabulary (Vocabulary): The loaded vocabulary.
+        """
+        if os.path.exists(path):
+            with np.load(path) as data:
+                tokens = data["tokens"]
+            # Note pairs are stored as rows of a 2D array and come back as tuples, chord names as strings
+            if tokens.ndim == 2:
+                return cls(tuple(row) for row in tokens.tolist())
+            return cls(tokens.tolist())
+        if seed_path is not None and os.path.exists(seed_path):
+            with open(seed_path, "rb") as infile:
+                return cls.from_mapping(pickle.load(infile))
+        return cls()
+
+    def save(self, path):
+        """
+        Writes the tokens, in id order, to one uncompressed .npz file.
+        """
+        np.savez(path, tokens=self.array)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, token):
+        return token in self.index
+
+    def __getitem__(self, token_id):
+        return self.tokens[token_id]
+
+    def add(self, token):
+        """
+        Gets the id of a token, appending it to the vocabulary if it is new.
+        """
+        token_id = self.index.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.tokens.append(token)
+            self.index[token] = token_id
+            self._array = None
+        return token_id
+
+    def extend(self, tokens):
+        """
+        Adds every new token, in first-seen order, and returns the ids of all of them.
+        """
+        return [self.add(token) for token in tokens]
+
+    def encode(self, tokens):
+        """
+        Turns a sequence of known tokens into an array of ids (KeyError for unknown tokens).
+        """
+        return np.array([self.index[token] for token in tokens], dtype=np.int32)
+
+    def decode(self, ids):
+        """
+        Turns an array of ids into the token array rows they stand for.
+        """
+        return self.array[np.asarray(ids)]
+
+    @property
+    def array(self):
+        """
+        Tokens as a numpy array indexed by id: shape (n, 2) for note pairs, a string array for chords.
+        """
+        if self._array is None:
+            if self.tokens and isinstance(self.tokens[0], tuple):
+                self._array = np.array(self.tokens, dtype=np.int16)
+            else:
+                self._array = np.array(self.tokens, dtype=str)
+        return self._array
+
+    def id_to_token(self):
+        """
+        Gets the vocabulary as an id -> token dict (the map_to_pair / map_to_chords form).
+        """
+        return dict(enumerate(self.tokens))
+
+    def token_to_id(self):
+        """
+        Gets the vocabulary as a token -> id dict (the pair_to_map / chords_to_map form).
+        """
+        return dict(self.index)
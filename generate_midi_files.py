@@ -5,6 +5,7 @@ from datetime import datetime
 
 
 from masterpiece import Masterpiece
+from chord_voicings import load_voicings
 from librosa import note_to_midi
 import predict_chords_utils as pcu
 
@@ -73,15 +74,11 @@ def generate_midi():
     chords = midi_chord_seq["chords"]
     chord_durations = midi_chord_seq["chord_durations"]
 
-    # get chord notes from chords using chord_to_notes.json
-    with open("./track_generation_files/chord_to_notes.json", "r") as f:
-        chord_to_notes = json.load(f)
-
-    chord_notes = []
-    for chord in chords:
-        if chord in chord_to_notes:
-            chord_notes.append(chord_to_notes[chord]["midi_notes"])
+    # get chord notes from the compiled voicing table, which covers every chord the HMM can predict,
+    # so the chord notes stay aligned with chord_durations
+    chord_notes = load_voicings().voicings(chords)
 
+    # rules.json only provides the defaults (velocities); the song's rules stay in memory
     with open("./track_generation_files/rules.json", "r") as f:
         rules = json.load(f)
 
@@ -90,12 +87,9 @@ def generate_midi():
     rules["chord_rhythm"] = chord_durations
     rules["seq_chord"] = chord_notes
 
-    with open("./track_generation_files/rules.json", "w") as f:
-        json.dump(rules, f)
-
     # create the masterpiece class and generate the MIDI file
     my_masterpiece = Masterpiece(
-        rules_path="./track_generation_files/rules.json",
+        rules=rules,
         length=params["length"],
         tempo=params["tempo"])
 
@@ -0,0 +1,293 @@
+"""Local asyncio HTTP/JSON service that harmonizes melodies with the cached HMM.
+
+Run from the repository root:
+    python harmonize_service.py --port 8765
+
+Endpoints:
+    POST /harmonize      {"notes": [...], "durations": [...]} -> {"chords": [...], "chord_durations": [...]}
+    POST /harmonize.mid  same body -> the rendered MIDI file (audio/midi)
+    GET  /stats          request counts, batch sizes, concurrency and latency percentiles
+    GET  /health         {"status": "ok"}
+
+Concurrent requests are coalesced into micro-batches that are decoded together with
+predict_chords_utils.get_chord_sequences, so many clients cost little more than one.
+"""
+import argparse
+import asyncio
+import json
+import math
+import time
+from collections import deque
+
+import numpy as np
+
+import predict_chords_utils as pcu
+from bulk_render import load_render_settings, render_batch, song_rules
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error",
+           503: "Service Unavailable"}
+
+
+class HarmonizeService:
+    """coalesces concurrent harmonize requests into micro-batches and keeps request statistics
+
+    A request waits at most max_wait seconds for others to join its batch, and a batch holds at most
+    max_batch melodies. At most max_concurrency requests are in flight; further ones are turned away
+    (HTTP 503) rather than queued without bound.
+    """
+
+    def __init__(self, max_batch=32, max_wait=0.005, max_concurrency=256, rng=None, hmm=None, latency_window=10000):
+        """
+        Args:
+            max_batch (int) : largest number of melodies decoded together
+            max_wait (float) : seconds the first request of a batch waits for more to arrive
+            max_concurrency (int) : largest number of requests in flight at once
+            rng (np.random.Generator or int, optional) : random generator or seed for reproducible chords
+            hmm (HiddenMarkovModel, optional) : model to decode with, the cached model from get_model if not given
+            latency_window (int) : number of most recent request latencies the percentiles are taken over
+        """
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_concurrency = max_concurrency
+        self.rng = np.random.default_rng(rng)
+        self.hmm = hmm
+        self.settings = None
+        self.queue = None
+        self.batcher = None
+        self.in_flight = 0
+        self.requests = 0
+        self.rejected = 0
+        self.batches = 0
+        self.batched_melodies = 0
+        self.latencies = deque(maxlen=latency_window)
+
+    async def start(self):
+        """load the model and render settings, and start the batching task"""
+        loop = asyncio.get_running_loop()
+        # loading is blocking file and numpy work, so it runs off the event loop
+        await loop.run_in_executor(None, pcu.warm_up)
+        if self.hmm is None:
+            self.hmm = pcu.get_model()
+        self.settings = await loop.run_in_executor(None, load_render_settings)
+        self.queue = asyncio.Queue()
+        self.batcher = asyncio.create_task(self._run_batches())
+
+    async def stop(self):
+        """stop the batching task"""
+        if self.batcher is not None:
+            self.batcher.cancel()
+            try:
+                await self.batcher
+            except asyncio.CancelledError:
+                pass
+            self.batcher = None
+
+    def busy(self):
+        """whether a new request would go over the concurrency limit"""
+        return self.in_flight >= self.max_concurrency
+
+    async def harmonize(self, notes, durations, midi=False):
+        """harmonize one melody, decoded in a batch together with any concurrent requests
+
+        Args:
+            notes (list) : MIDI notes of the melody
+            durations (list) : durations of the notes in beats
+            midi (bool) : also render the harmonized melody to MIDI file bytes
+
+        Returns:
+            dict : chords and chord_durations, plus midi (bytes) if requested
+        """
+        # an unknown note pair would fail the whole batch, so it is caught here for this request alone
+        pairs, _ = pcu.get_pairs(list(pcu.standardize_octave(np.array(notes))), durations)
+        unknown = [pair for pair in pairs if pair not in pcu.get_vocabulary(self.hmm)["pair_to_map"]]
+        if unknown:
+            raise KeyError(f"note pairs not in the vocabulary: {[tuple(int(n) for n in pair) for pair in unknown]}")
+        start = time.perf_counter()
+        self.in_flight += 1
+        try:
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put((notes, durations, midi, future))
+            return await future
+        finally:
+            self.in_flight -= 1
+            self.requests += 1
+            self.latencies.append(time.perf_counter() - start)
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batches += 1
+            self.batched_melodies += len(batch)
+            try:
+                # decoding and rendering are CPU work, done off the event loop so requests keep arriving meanwhile
+                results = await loop.run_in_executor(None, self._process, batch)
+            except Exception:
+                # one bad melody must not fail the others, so the batch is retried one request at a time
+                results = []
+                for item in batch:
+                    try:
+                        results.extend(await loop.run_in_executor(None, self._process, [item]))
+                    except Exception as error:
+                        results.append(RuntimeError(f"harmonizing failed: {type(error).__name__}: {error}"))
+            for (*_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _process(self, batch):
+        """decode a batch of melodies together and render the ones that asked for MIDI"""
+        results = pcu.get_chord_sequences([(notes, durations) for notes, durations, _, _ in batch],
+                                          rng=self.rng, hmm=self.hmm)
+        # the MIDI files of a batch are rendered together too
+        wanted = [(notes, durations, result) for (notes, durations, midi, _), result in zip(batch, results) if midi]
+        files = render_batch([song_rules(notes, durations, result["chords"], result["chord_durations"], self.settings)
+                              for notes, durations, result in wanted],
+                             length=self.settings["length"], tempo=self.settings["tempo"])
+        for (_, _, result), midi in zip(wanted, files):
+            result["midi"] = midi
+        return results
+
+    def stats(self):
+        """request statistics: counts, mean batch size, concurrency and latency percentiles in milliseconds"""
+        latencies = np.array(self.latencies) * 1000
+        percentiles = np.percentile(latencies, [50, 90, 99]) if len(latencies) else [0.0, 0.0, 0.0]
+        return {
+            "requests": self.requests,
+            "rejected": self.rejected,
+            "batches": self.batches,
+            "mean_batch_size": self.batched_melodies / self.batches if self.batches else 0.0,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "max_batch": self.max_batch,
+            "latency_ms": dict(zip(["p50", "p90", "p99"], (round(float(p), 3) for p in percentiles))),
+        }
+
+
+def parse_melody(body):
+    """read and check the notes and durations of a harmonize request body (durations must be finite and positive)
+
+    Args:
+        body (bytes) : JSON request body
+
+    Returns:
+        tuple : (notes, durations)
+    """
+    request = json.loads(body)
+    notes, durations = request["notes"], request["durations"]
+    if len(notes) != len(durations) or len(notes) < 2:
+        raise ValueError("notes and durations must have the same length, at least 2")
+    notes = [float(note) for note in notes]
+    durations = [float(duration) for duration in durations]
+    # JSON allows NaN and Infinity, which would otherwise reach the decoder and come back as invalid JSON
+    if not all(math.isfinite(note) for note in notes):
+        raise ValueError("notes must be finite numbers")
+    if not all(math.isfinite(duration) and duration > 0 for duration in durations):
+        raise ValueError("durations must be finite and positive")
+    return [int(note) for note in notes], durations
+
+
+async def handle_request(service, method, path, body):
+    """route one HTTP request
+
+    Returns:
+        tuple : (status code, content type, body bytes)
+    """
+    if path == "/health":
+        return 200, "application/json", b'{"status": "ok"}'
+    if path == "/stats":
+        return 200, "application/json", json.dumps(service.stats()).encode()
+    if path not in ("/harmonize", "/harmonize.mid"):
+        return 404, "application/json", b'{"error": "not found"}'
+    if method != "POST":
+        return 405, "application/json", b'{"error": "use POST"}'
+    if service.busy():
+        service.rejected += 1
+        return 503, "application/json", b'{"error": "too many requests in flight"}'
+    try:
+        notes, durations = parse_melody(body)
+        result = await service.harmonize(notes, durations, midi=path == "/harmonize.mid")
+    except (ValueError, KeyError, TypeError) as error:
+        # a malformed body or a melody with note pairs the model does not know
+        return 400, "application/json", json.dumps({"error": str(error)}).encode()
+    except Exception as error:
+        # anything failing while decoding or rendering a melody that passed the checks is the service's fault
+        return 500, "application/json", json.dumps({"error": str(error)}).encode()
+    if path == "/harmonize.mid":
+        return 200, "audio/midi", result["midi"]
+    return 200, "application/json", json.dumps(result).encode()
+
+
+async def handle_connection(service, reader, writer):
+    """serve HTTP/1.1 requests on one connection, keeping it open between requests unless asked to close"""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            status, content_type, payload = await handle_request(service, method, path, body)
+            keep_alive = headers.get("connection", "").lower() != "close"
+            writer.write(
+                f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                .encode("latin-1") + payload)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(service, host="127.0.0.1", port=8765):
+    """start the service and an HTTP server for it
+
+    Returns:
+        asyncio.Server : the listening server (port 0 picks a free port, see server.sockets)
+    """
+    await service.start()
+    return await asyncio.start_server(lambda r, w: handle_connection(service, r, w), host, port)
+
+
+async def main(host, port, max_batch, max_wait, max_concurrency):
+    service = HarmonizeService(max_batch=max_batch, max_wait=max_wait, max_concurrency=max_concurrency)
+    server = await serve(service, host, port)
+    print(f"Harmonizing on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve chord harmonization over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch", type=int, default=32, help="largest number of melodies decoded together")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0,
+                        help="how long a request waits for others to join its batch")
+    parser.add_argument("--max-concurrency", type=int, default=256,
+                        help="requests in flight before new ones get HTTP 503")
+    args = parser.parse_args()
+    asyncio.run(main(args.host, args.port, args.max_batch, args.max_wait_ms / 1000, args.max_concurrency))
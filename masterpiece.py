@@ -1,5 +1,6 @@
 # adapted from https://github.com/Jobsecond/random-midi
 
+import io
 import json
 
 from midiutil.MidiFile import MIDIFile
@@ -9,14 +10,23 @@ class Masterpiece(object):
     """Object that generates a MIDI file based on a set of rules.
     """
 
-    def __init__(self, rules_path="./track_generation_files/rules.json", length=4, tempo=90):
+    def __init__(self, rules_path="./track_generation_files/rules.json", length=4, tempo=90, rules=None):
+        """
+        Args:
+            rules_path (str) : JSON file the rules are read from when rules is not given
+            length (int) : number of times the melody is repeated
+            tempo (int) : tempo in beats per minute
+            rules (dict, optional) : rules already in memory (notes, rhythm, seq_chord, chord_rhythm, velocity),
+                so no file is read
+        """
         self.rules_path = rules_path
         self.length = length
         self.tempo = tempo
 
-        rules_file = open(rules_path, "r")
-        rules = json.load(rules_file)
-        rules_file.close()
+        if rules is None:
+            rules_file = open(rules_path, "r")
+            rules = json.load(rules_file)
+            rules_file.close()
         self.rhythm = rules["rhythm"]
         self.seq_chord = rules["seq_chord"]
         self.chord_rhythm = rules["chord_rhythm"]
@@ -104,12 +114,32 @@ class Masterpiece(object):
             pos += rhythm
         self.current_track_number += 1
 
-    def create_midi_file(self, filename, melody=True, chord=True):
+    def render(self, output=None, melody=True, chord=True):
+        """Render the tracks to MIDI, starting from an empty MIDI file so it can be rendered any number of times.
 
-        """Create the MIDI file based on the rules."""
+        Args:
+            output (file-like, optional) : binary file-like object the MIDI file is written to
+            melody (bool) : include the melody track
+            chord (bool) : include the chord track
+
+        Returns:
+            bytes : the MIDI file, if no output was given
+        """
+        self.MyMIDI = MIDIFile(3)
+        self.current_track_number = 0
         if melody:
             self.create_melody_track()
         if chord:
             self.create_chord_track()
+        if output is not None:
+            self.MyMIDI.writeFile(output)
+            return None
+        buffer = io.BytesIO()
+        self.MyMIDI.writeFile(buffer)
+        return buffer.getvalue()
+
+    def create_midi_file(self, filename, melody=True, chord=True):
+
+        """Create the MIDI file based on the rules."""
         with open(filename, "wb") as midi_file:
-            self.MyMIDI.writeFile(midi_file)
+            self.render(midi_file, melody=melody, chord=chord)
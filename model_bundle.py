@@ -0,0 +1,142 @@
+"""Single-file binary format for a trained chord HMM.
+
+Layout: the magic bytes b"HMMB", a little-endian uint32 format version and a uint32 header length, then a
+JSON header giving the dtype, shape and byte offset of every array, then the raw arrays, each aligned to
+64 bytes. load_bundle memory-maps the arrays read-only, so loading costs a few milliseconds no matter how
+large the matrices are.
+
+Run this module directly to convert the CSV matrices in training/ (plus the corpus and vocabulary pickles in
+clean_data/) into training/model.hmmb.
+"""
+import json
+import os
+import pickle
+import struct
+
+import numpy as np
+
+MAGIC = b"HMMB"
+VERSION = 1
+ALIGNMENT = 64
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FILE_PATH = os.path.join(BASE_DIR, "clean_data")
+ET_FILE_PATH = os.path.join(BASE_DIR, "training")
+BUNDLE_PATH = os.path.join(ET_FILE_PATH, "model.hmmb")
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def save_bundle(path, arrays):
+    """write arrays to a versioned model bundle
+
+    Args:
+        path (str) : output file path
+        arrays (dict) : array name -> numpy array (any fixed-size dtype, including fixed-width strings)
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    entries = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = _aligned(offset)
+        entries[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += array.nbytes
+    header = json.dumps({"version": VERSION, "arrays": entries}).encode()
+    # arrays start at the first aligned position after the preamble and header
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    with open(path, "wb") as outfile:
+        outfile.write(MAGIC + struct.pack("<II", VERSION, len(header)) + header)
+        for name, array in arrays.items():
+            outfile.seek(data_start + entries[name]["offset"])
+            outfile.write(array.tobytes())
+
+
+def load_bundle(path):
+    """memory-map every array of a model bundle read-only
+
+    Args:
+        path (str) : bundle file path
+
+    Returns:
+        dict : array name -> read-only numpy memmap
+    """
+    with open(path, "rb") as infile:
+        magic = infile.read(len(MAGIC))
+        version, header_length = struct.unpack("<II", infile.read(8))
+        header = json.loads(infile.read(header_length))
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a model bundle")
+    if version != VERSION:
+        raise ValueError(f"Unsupported model bundle version {version} (expected {VERSION})")
+
+    data_start = _aligned(len(MAGIC) + 8 + header_length)
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        shape = tuple(entry["shape"])
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=entry["dtype"])
+            continue
+        arrays[name] = np.memmap(path, dtype=entry["dtype"], mode="r", offset=data_start + entry["offset"],
+                                 shape=shape)
+    return arrays
+
+
+def model_arrays(transitions, emissions, chords_by_piece, map_to_chords, map_to_pair,
+                 start_probs=None, end_probs=None):
+    """collect everything needed to rebuild the HMM and decode its output into bundle arrays
+
+    Args:
+        transitions (np.ndarray) : trained transition matrix [state, next_state]
+        emissions (np.ndarray) : trained emission matrix [state, observation]
+        chords_by_piece (list) : chord ids of each piece, used for the start/end probabilities
+        map_to_chords (dict) : chord id -> chord name
+        map_to_pair (dict) : note pair id -> (note, note)
+        start_probs (np.ndarray, optional) : trained start probabilities, counted from the pieces if not given
+        end_probs (np.ndarray, optional) : trained end probabilities, counted from the pieces if not given
+
+    Returns:
+        dict : array name -> numpy array, ready for save_bundle
+    """
+    # the states and observations are the whole vocabularies, so chord and pair ids index T and E directly
+    true_states = np.arange(len(map_to_chords))
+    n = len(true_states)
+    firsts = np.array([piece[0] for piece in chords_by_piece], dtype=np.int64)
+    lasts = np.array([piece[-1] for piece in chords_by_piece], dtype=np.int64)
+
+    chord_names = np.array([map_to_chords[i] for i in range(len(map_to_chords))])
+    note_pairs = np.array([map_to_pair[i] for i in range(len(map_to_pair))], dtype=np.int64)
+    return {
+        "transitions": np.asarray(transitions, dtype=np.float64),
+        "emissions": np.asarray(emissions, dtype=np.float64),
+        "start_probs": np.bincount(firsts, minlength=n) / n if start_probs is None else np.asarray(start_probs),
+        "end_probs": np.bincount(lasts, minlength=n) / n if end_probs is None else np.asarray(end_probs),
+        "true_states": true_states.astype(np.int64),
+        "observable_states": np.arange(len(map_to_pair), dtype=np.int64),
+        "chord_names": chord_names,
+        "note_pairs": note_pairs,
+    }
+
+
+def convert_csv(output_path=BUNDLE_PATH):
+    """convert training/transitions.csv and training/emissions.csv (plus the corpus and vocabulary pickles) to a bundle"""
+    from clean_data.corpus import Corpus
+
+    corpus = Corpus.load()
+    pickles = {}
+    for name in ["map_to_chords", "map_to_pair"]:
+        with open(os.path.join(FILE_PATH, name + ".pkl"), "rb") as infile:
+            pickles[name] = pickle.load(infile)
+    with open(os.path.join(ET_FILE_PATH, "transitions.csv"), "r") as infile:
+        transitions = np.genfromtxt(infile, delimiter=",")
+    with open(os.path.join(ET_FILE_PATH, "emissions.csv"), "r") as infile:
+        emissions = np.genfromtxt(infile, delimiter=",")
+    save_bundle(output_path, model_arrays(
+        transitions, emissions, corpus.pieces("chord_id"), pickles["map_to_chords"], pickles["map_to_pair"]))
+
+
+if __name__ == "__main__":
+    convert_csv()
+    print(f"Wrote {BUNDLE_PATH}")
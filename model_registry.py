@@ -0,0 +1,70 @@
+import hashlib
+import os
+import threading
+
+# built models keyed on the content hash of the artifacts they were built from
+_models = {}
+# (path, size, mtime) -> sha256 of the file, so unchanged files are not re-hashed on every lookup
+_file_hashes = {}
+_lock = threading.Lock()
+
+
+def file_hash(path):
+    """sha256 of a file's contents, re-hashed only when its size or modification time changes
+
+    Args:
+        path (str) : path to the file
+
+    Returns:
+        str : hex digest of the file contents
+    """
+    stat = os.stat(path)
+    stamp = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    digest = _file_hashes.get(stamp)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(path, "rb") as infile:
+            for block in iter(lambda: infile.read(1 << 20), b""):
+                sha.update(block)
+        digest = sha.hexdigest()
+        _file_hashes[stamp] = digest
+    return digest
+
+
+def artifacts_key(paths):
+    """key identifying a set of training artifacts by their contents
+
+    Args:
+        paths (list) : paths to the artifact files
+
+    Returns:
+        str : combined hash of all the files
+    """
+    sha = hashlib.sha256()
+    for path in paths:
+        sha.update(file_hash(path).encode())
+    return sha.hexdigest()
+
+
+def get_model(paths, build):
+    """get the model built from the given artifacts, building it only the first time they are seen
+
+    Args:
+        paths (list) : paths to the artifact files the model is built from
+        build (callable) : function with no arguments that builds the model from those files
+
+    Returns:
+        object : the cached model
+    """
+    key = artifacts_key(paths)
+    with _lock:
+        if key not in _models:
+            _models[key] = build()
+        return _models[key]
+
+
+def clear():
+    """drop every cached model"""
+    with _lock:
+        _models.clear()
+        _file_hashes.clear()
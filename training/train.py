@@ -1,58 +1,59 @@
-import pickle
+import argparse
+import os
 import numpy as np
-import copy
-from tqdm import tqdm
 import sys
-sys.path.append(r'/Users/christinahe/Downloads/cs4100-final-proj')
-from HMM import HiddenMarkovModel
 
-FILE_PATH = r'/Users/christinahe/Downloads/cs4100-final-proj/clean_data/'
-
-def main():
-    # Load chord and note data for each piece from pickled files
-    with open(FILE_PATH+"piece_mapped_chords.pkl", "rb") as infile:
-        chords_by_piece = pickle.load(infile)
-    with open(FILE_PATH+"piece_mapped_notes.pkl", "rb") as infile:
-        notes_by_piece = pickle.load(infile)
-    # Load chord and note data for all pieces from pickled files
-    with open(FILE_PATH+"separated_mapped_chords.pkl", "rb") as infile:
-        all_chords = pickle.load(infile)
-    with open(FILE_PATH+"separated_mapped_notes.pkl", "rb") as infile:
-        all_notes = pickle.load(infile)
-
-    # Get unique chords and notes and their counts
-    unique_chords = set(all_chords)
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+from HMM import HiddenMarkovModel
+from model_bundle import model_arrays, save_bundle
+from clean_data.corpus import Corpus
+from clean_data.vocabulary import CHORD_VOCAB_PATH, PAIR_VOCAB_PATH, Vocabulary
+
+FILE_PATH = os.path.join(BASE_DIR, "clean_data") + os.sep
+
+def main(workers=None):
+    # Load the columnar corpus; each piece's chords and notes are views into its flat columns
+    corpus = Corpus.load()
+    chords_by_piece = corpus.pieces("chord_id")
+    notes_by_piece = corpus.pieces("pair_id")
+    # Load the persisted vocabularies so the model bundle can decode its own output
+    map_to_chords = Vocabulary.load(CHORD_VOCAB_PATH, seed_path=FILE_PATH+"map_to_chords.pkl")
+    map_to_pair = Vocabulary.load(PAIR_VOCAB_PATH, seed_path=FILE_PATH+"map_to_pair.pkl")
+
+    # States and observations are the whole vocabularies, so an id is always its own row / column; ids that no
+    # longer occur in the corpus (e.g. from an excluded piece) just get zero counts instead of shifting later ids
+    unique_chords = np.arange(len(map_to_chords))
     n = len(unique_chords)
-    unique_notes = set(all_notes)
+    unique_notes = np.arange(len(map_to_pair))
     n_notes = len(unique_notes)
 
     # Get first and last chords for each pieve
-    firsts = [elem[0] for elem in chords_by_piece]
-    lasts = [elem[-1] for elem in chords_by_piece]
+    firsts = [int(elem[0]) for elem in chords_by_piece]
+    lasts = [int(elem[-1]) for elem in chords_by_piece]
     # Calculate probabilities for first and last chords
-    first_probs = np.array([firsts.count(i) / n for i in unique_chords])
-    last_probs = np.array([lasts.count(i) / n for i in unique_chords])
+    first_probs = np.bincount(firsts, minlength=n) / n
+    last_probs = np.bincount(lasts, minlength=n) / n
     transitions = 1/n * np.ones((n, n))
     emmissions = 1/n * np.ones((n, n_notes))
 
     # Initialize a HMM
-    model = HiddenMarkovModel(np.array(list(unique_chords)), np.array(list(unique_notes)), transitions, emmissions, first_probs, last_probs)
-    # Train a model on each piece
-    models = [copy.copy(model) for _ in notes_by_piece]
-    trained_models = []
-    for i in tqdm(range(len(models))):
-        trained_models.append(models[i].train(notes_by_piece[i]))
-
-    # Calculate average emissions and transitions from trained models
-    emmissions = np.mean([elem.E for elem in models], axis=0)
-    transitions = np.mean([elem.T for elem in models], axis=0)
-
-    # Print and save the emission and transition probabilities
+    model = HiddenMarkovModel(unique_chords, unique_notes, transitions, emmissions, first_probs, last_probs)
+    # Train one model on all pieces at once (pooled Baum-Welch over the whole corpus)
+    # with workers > 1 each iteration's E-step is split across that many processes
+    model.train(notes_by_piece, workers=workers)
+    emmissions = model.E
+    transitions = model.T
+
+    # Print and save the trained model as a single binary bundle
     print(emmissions)
     print(transitions)
-    np.savetxt("transitions.csv", transitions, delimiter=",", fmt='%.20f')
-    np.savetxt("emissions.csv", emmissions, delimiter=",", fmt='%.20f')
-
+    save_bundle(os.path.join(BASE_DIR, "training", "model.hmmb"), model_arrays(
+        transitions, emmissions, chords_by_piece, map_to_chords, map_to_pair,
+        start_probs=model.start_probs, end_probs=model.end_probs))
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Train the chord HMM on every piece in the corpus")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of processes for the E-step (default: train in this process)")
+    main(parser.parse_args().workers)